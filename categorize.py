@@ -1,161 +1,1953 @@
-import os, time, json
-import tensorflow as tf
+import os, time, json, queue, atexit, select, struct, threading, hashlib, sqlite3, urllib.request
+import ctypes, ctypes.util
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import cached_property
+from itertools import chain, islice, repeat
 import numpy as np
 from PIL import Image
 
 # ----------------------------
-# File paths
+# File paths (override the data folder with GALLERYZE_DATA_DIR, or pass paths to Categorizer)
 # ----------------------------
-DETECTION_MODEL_PATH = '/content/sample_data/ssd_mobilenet_v2_coco_quantized.tflite'
-CLASSIFIER_MODEL_PATH = '/content/sample_data/mobilenet_v2_imagenet_quantized.tflite'
-MAPPING_JSON_PATH = '/content/sample_data/CategorizedClasses.json'
-CATEGORIZED_JSON_PATH = os.path.join('/content/sample_data', "categorized.json")  # Folder for output JSON
-CHECKPOINT_PATH = os.path.join('/content/sample_data/', "last_processed.txt")       # Checkpoint file
+DATA_DIR = os.environ.get('GALLERYZE_DATA_DIR', '/content/sample_data')
+DETECTION_MODEL_PATH = os.path.join(DATA_DIR, 'ssd_mobilenet_v2_coco_quantized.tflite')
+CLASSIFIER_MODEL_PATH = os.path.join(DATA_DIR, 'mobilenet_v2_imagenet_quantized.tflite')
+MAPPING_JSON_PATH = os.path.join(DATA_DIR, 'CategorizedClasses.json')  # or assets/image_labelling_classes.json
+CATEGORIZED_JSON_PATH = os.path.join(DATA_DIR, "categorized.json")  # Folder for output JSON
+CHECKPOINT_PATH = os.path.join(DATA_DIR, "last_processed.txt")       # Checkpoint file
+RESULT_CACHE_PATH = os.path.join(DATA_DIR, "result_cache.sqlite")    # Content-hash result cache
+RESULT_STORE_PATH = os.path.join(DATA_DIR, "categorized.sqlite")     # Per-image result store
+EMBEDDINGS_PATH = os.path.join(DATA_DIR, "embeddings")               # embeddings.f16 matrix + embeddings.sqlite ids
+COCO_LABELS_PATH = os.path.join(DATA_DIR, 'coco-labels.txt')
+# Same class index file keras' decode_predictions downloads and caches
+IMAGENET_CLASS_INDEX_URL = 'https://storage.googleapis.com/download.tensorflow.org/data/imagenet_class_index.json'
+IMAGENET_CLASS_INDEX_PATH = os.path.join(os.path.expanduser('~'), '.keras', 'models', 'imagenet_class_index.json')
+CATEGORIES = ["Docs", "People", "Animal", "Nature", "Food", "Others"]
+CATEGORY_ALIASES = {"Document": "Docs"}  # assets/image_labelling_classes.json names Docs "Document"
+CLASSIFIER_TOP_K = 5  # number of classifier predictions fused into the category scores
+
+# The detector only resolves these categories; everything else falls through to the classifier
+DETECTOR_CATEGORIES = (None, "Docs", "People")
+
+SUPPORTED_FORMATS = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
+
+# Cascade stages, in the order they run by default (the original detector-first behaviour)
+CASCADE_STAGES = ("detector", "classifier")
 
 # ----------------------------
-# Load the JSON mapping file
+# Interpreter backends (imported on first use, so importing this module stays cheap)
 # ----------------------------
-with open(MAPPING_JSON_PATH, 'r') as f:
-    mapping_dict = json.load(f)
-for key in mapping_dict:
-    mapping_dict[key] = [s.lower() for s in mapping_dict[key]]
+def load_tensorflow():
+    import tensorflow as tf
+    return tf
+
+def interpreter_class(use_tflite_runtime=True):
+    # The standalone tflite_runtime package is much lighter than full TensorFlow
+    if use_tflite_runtime:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+            return Interpreter
+        except ImportError:
+            pass
+    return load_tensorflow().lite.Interpreter
 
 # ----------------------------
-# Load TFLite models
+# Label mapping helpers
 # ----------------------------
-detector = tf.lite.Interpreter(model_path=DETECTION_MODEL_PATH)
-detector.allocate_tensors()
+def normalize_label(label):
+    # ImageNet descriptions use underscores ("golden_retriever"), the label vocabularies use spaces
+    return label.strip().lower().replace('_', ' ')
 
-classifier = tf.lite.Interpreter(model_path=CLASSIFIER_MODEL_PATH)
-classifier.allocate_tensors()
+def build_label_index(mapping):
+    # Reverse index label -> category, built once instead of scanning every category per lookup.
+    # The first category listing a label wins, as with the old linear scan.
+    label_index = {}
+    for category, keywords in mapping.items():
+        category = CATEGORY_ALIASES.get(category, category)
+        for keyword in keywords:
+            label_index.setdefault(normalize_label(keyword), category)
+    return label_index
 
-# For detection, load the COCO labels (assumed one label per line)
-with open('/content/sample_data/coco-labels.txt', 'r') as f:
-    coco_labels = [line.strip().lower() for line in f.readlines()]
+def load_imagenet_labels(class_index_path=IMAGENET_CLASS_INDEX_PATH):
+    # Fetched once into the keras cache location if it is not there yet
+    if not os.path.exists(class_index_path):
+        os.makedirs(os.path.dirname(class_index_path), exist_ok=True)
+        urllib.request.urlretrieve(IMAGENET_CLASS_INDEX_URL, class_index_path + '.tmp')
+        os.replace(class_index_path + '.tmp', class_index_path)
+    with open(class_index_path, 'r') as f:
+        class_index = json.load(f)
+    return [class_index[str(i)][1] for i in range(len(class_index))]
 
 # ----------------------------
 # Preprocessing functions
 # ----------------------------
-def preprocess_image_for_detector(image, input_size):
-    image = image.resize(input_size, Image.Resampling.LANCZOS)
+def load_image(image_path, draft_size=None):
+    image = Image.open(image_path)
+    if draft_size is not None:
+        # Let the JPEG decoder scale down by 1/2, 1/4 or 1/8 while staying at least draft_size.
+        # draft() is a no-op for formats other than JPEG.
+        image.draft('RGB', draft_size)
+    return image.convert('RGB')
+
+# What one bad file can raise: a truncated or corrupt image fails to decode with OSError (or SyntaxError and
+# DecompressionBombError from some PIL plugins), and an image the models cannot take fails with ValueError or
+# RuntimeError. categorize_files skips such a file and carries on with the rest.
+IMAGE_ERRORS = (OSError, SyntaxError, ValueError, RuntimeError, Image.DecompressionBombError)
+
+def downscale_for_models(image, input_size, resample=Image.Resampling.LANCZOS):
+    # Resize once to the largest model input so both model inputs can be derived from the result.
+    # Returns the image and the filter to use for the remaining per-model resizes;
+    # resample=None keeps the old behaviour of resizing the decoded image separately for each model.
+    if resample is None:
+        return image, Image.Resampling.LANCZOS
+    if image.size != tuple(input_size):
+        image = image.resize(input_size, resample)
+    return image, resample
+
+def preprocess_image_for_detector(image, input_size, resample=Image.Resampling.LANCZOS, out=None):
+    # With out (an (h, w, 3) row of an input tensor) the pixels are written in place
+    if image.size != tuple(input_size):
+        image = image.resize(input_size, resample)
+    if out is not None:
+        out[...] = np.asarray(image)
+        return out
     img_array = np.array(image)
     return np.expand_dims(img_array, axis=0).astype(np.uint8)
 
-def preprocess_image_for_classifier(image, target_size=(224, 224)):
-    image = image.resize(target_size, Image.Resampling.LANCZOS)
-    img_array = tf.keras.preprocessing.image.img_to_array(image)
-    img_array = np.expand_dims(img_array, axis=0)
-    return tf.keras.applications.mobilenet_v2.preprocess_input(img_array)
+def classifier_input_lut(input_details=None):
+    # 256-entry pixel lookup table applying MobileNetV2 scaling (x / 127.5 - 1), quantized to the
+    # model's input dtype when it has one, so preprocessing is a single table lookup per pixel
+    scaled = np.arange(256, dtype=np.float32) / 127.5 - 1.0
+    if input_details is None or input_details['dtype'] == np.float32:
+        return scaled
+    scale, zero_point = input_details['quantization']
+    info = np.iinfo(input_details['dtype'])
+    quantized = np.round(scaled / scale + zero_point) if scale else np.arange(256)
+    return np.clip(quantized, info.min, info.max).astype(input_details['dtype'])
+
+MOBILENET_FLOAT_LUT = classifier_input_lut()
+
+def preprocess_image_for_classifier(image, target_size=(224, 224), resample=Image.Resampling.LANCZOS,
+                                    lut=MOBILENET_FLOAT_LUT, out=None):
+    # Pure NumPy replacement for keras img_to_array + mobilenet_v2.preprocess_input.
+    # With out (an (h, w, 3) row of a preallocated batch buffer) the result is written in place.
+    if image.size != tuple(target_size):
+        image = image.resize(target_size, resample)
+    pixels = np.asarray(image)
+    if out is not None:
+        return np.take(lut, pixels, out=out)
+    return np.expand_dims(np.take(lut, pixels), axis=0)
 
 # ----------------------------
-# Helper function: mapping prediction to category
+# Hashing helpers
 # ----------------------------
-def map_prediction_to_category(pred_label, mapping):
-    pred_label = pred_label.lower()
-    for category, keywords in mapping.items():
-        if pred_label in keywords:
-            return category
-    return 'Others'
+def fingerprint_files(paths):
+    digest = hashlib.blake2b(digest_size=16)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
 
 # ----------------------------
-# Hybrid pipeline function (original approach)
+# Perceptual hashing and near-duplicate index
 # ----------------------------
-def hybrid_pipeline(image_path, confidence_threshold=0.35):
-    image = Image.open(image_path).convert('RGB')
+PHASH_SIZE = 8  # 8x8 gradient bits = 64-bit hash
+
+def perceptual_hash(image, hash_size=PHASH_SIZE):
+    # dHash: one bit per horizontally neighbouring pixel pair of a tiny grayscale thumbnail,
+    # so bursts and re-encodes of the same shot land within a few bits of each other
+    thumbnail = image.convert('L').resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = np.packbits(pixels[:, 1:] > pixels[:, :-1])
+    return int.from_bytes(bits.tobytes(), 'big')
+
+def hamming_distance(hash_a, hash_b):
+    return (hash_a ^ hash_b).bit_count()
 
-    # --- Step 1: Run the detector ---
-    det_input_details = detector.get_input_details()
-    det_output_details = detector.get_output_details()
-    det_input_size = (det_input_details[0]['shape'][1], det_input_details[0]['shape'][2])
+class BKTree:
+    # Burkhard-Keller tree over Hamming distance: a search only descends into children whose edge
+    # distance is within max_distance of the query's distance to the node
+    def __init__(self):
+        self.root = None  # node: [hash, values, {distance: child node}]
 
-    det_input = preprocess_image_for_detector(image, det_input_size)
-    detector.set_tensor(det_input_details[0]['index'], det_input)
-    detector.invoke()
+    def add(self, phash, value):
+        if self.root is None:
+            self.root = [phash, [value], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming_distance(phash, node[0])
+            if distance == 0:
+                node[1].append(value)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [phash, [value], {}]
+                return
+            node = child
 
-    boxes = detector.get_tensor(det_output_details[0]['index'])[0]
-    class_ids = detector.get_tensor(det_output_details[1]['index'])[0]
-    scores = detector.get_tensor(det_output_details[2]['index'])[0]
+    def search(self, phash, max_distance):
+        # Returns [(distance, value)] for every value within max_distance, nearest first
+        matches = []
+        nodes = [self.root] if self.root is not None else []
+        while nodes:
+            node_hash, values, children = nodes.pop()
+            distance = hamming_distance(phash, node_hash)
+            if distance <= max_distance:
+                matches.extend((distance, value) for value in values)
+            nodes.extend(
+                child for edge, child in children.items() if distance - max_distance <= edge <= distance + max_distance
+            )
+        matches.sort(key=lambda match: match[0])
+        return matches
 
-    for i, score in enumerate(scores):
-        if score >= confidence_threshold:
-            detected_label = coco_labels[int(class_ids[i])].lower()
-            # If detected label belongs to "Docs" or "People", immediately return those fixed categories
-            if detected_label in mapping_dict.get("Docs", []):
-                return "Docs"
-            if detected_label in mapping_dict.get("People", []):
-                return "People"
+    def nearest(self, phash, max_distance):
+        matches = self.search(phash, max_distance)
+        return matches[0][1] if matches else None
 
-    # --- Step 2: Run the classifier ---
-    cls_input_details = classifier.get_input_details()
-    cls_output_details = classifier.get_output_details()
-    cls_input_size = (cls_input_details[0]['shape'][1], cls_input_details[0]['shape'][2])
+def build_duplicate_index(store):
+    # (BK-tree of stored hashes, {path: category}) for near-duplicate lookups; categorize_files keeps both
+    # up to date as it adds images
+    tree = BKTree()
+    known_categories = {}
+    for image_path, category, phash in store.hashes():
+        known_categories[image_path] = category
+        tree.add(phash, image_path)
+    return tree, known_categories
 
-    cls_input = preprocess_image_for_classifier(image, target_size=cls_input_size)
-    classifier.set_tensor(cls_input_details[0]['index'], cls_input)
-    classifier.invoke()
+def duplicate_clusters(path_hashes, max_distance=4):
+    # path_hashes is {path: hash}; returns groups (lists of 2+ paths) linked by near-duplicate pairs
+    tree = BKTree()
+    parent = {}
 
-    preds = classifier.get_tensor(cls_output_details[0]['index'])
-    decoded = tf.keras.applications.mobilenet_v2.decode_predictions(preds, top=1)
-    predicted_desc = decoded[0][0][1]
-    return map_prediction_to_category(predicted_desc, mapping_dict)
+    def find(path):
+        while parent[path] != path:
+            parent[path] = parent[parent[path]]
+            path = parent[path]
+        return path
+
+    for image_path, phash in path_hashes.items():
+        parent[image_path] = image_path
+        for _, other_path in tree.search(phash, max_distance):
+            parent[find(other_path)] = find(image_path)
+        tree.add(phash, image_path)
+
+    clusters = {}
+    for image_path in path_hashes:
+        clusters.setdefault(find(image_path), []).append(image_path)
+    return [paths for paths in clusters.values() if len(paths) > 1]
 
 # ----------------------------
-# Batch processing for folder with checkpointing
+# Per-stage cascade statistics
 # ----------------------------
-def process_folder(folder_path, confidence_threshold=0.35):
-    supported_formats = (".jpg", ".jpeg", ".png", ".bmp", ".gif")
+class CascadeStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> {"runs": images run, "hits": images resolved there, "confident": images the classifier
+        # scored at or above classifier_exit_threshold wherever it ran, "seconds": time spent};
+        # the pre-filter's hits are the images it let skip the detector
+        self.stages = {}
 
-    # Load existing categorized data, if available
-    if os.path.exists(CATEGORIZED_JSON_PATH):
-        with open(CATEGORIZED_JSON_PATH, "r") as json_file:
-            categorized_data = json.load(json_file)
-    else:
-        categorized_data = {"Docs": [], "People": [], "Animal": [], "Nature": [], "Food": [], "Others": []}
+    def record(self, stage, runs, hits, seconds, confident=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {"runs": 0, "hits": 0, "confident": 0, "seconds": 0.0})
+            totals["runs"] += runs
+            totals["hits"] += hits
+            totals["confident"] += confident
+            totals["seconds"] += seconds
+
+    def summary(self):
+        # {stage: {"runs", "hits", "hit_rate", "confident_rate", "seconds_per_image"}}
+        with self.lock:
+            return {
+                stage: {
+                    "runs": totals["runs"],
+                    "hits": totals["hits"],
+                    "hit_rate": totals["hits"] / totals["runs"] if totals["runs"] else 0.0,
+                    "confident_rate": totals["confident"] / totals["runs"] if totals["runs"] else 0.0,
+                    "seconds_per_image": totals["seconds"] / totals["runs"] if totals["runs"] else 0.0,
+                }
+                for stage, totals in self.stages.items()
+            }
+
+    def estimated_cost(self, order):
+        # Expected seconds per image for a stage order, treating the observed rates as independent.
+        # Comparing estimated_cost(("detector", "classifier")) with the reverse order picks the cheaper one.
+        # A classifier ahead of the detector only resolves the images it is confident about, so its exit rate
+        # is the confident rate, which is measured whatever order actually ran (its hit rate is 1.0 when last).
+        summary = self.summary()
+        cost, reach = 0.0, 1.0
+        for stage in order:
+            stats = summary.get(stage, {"hit_rate": 0.0, "confident_rate": 0.0, "seconds_per_image": 0.0})
+            cost += reach * stats["seconds_per_image"]
+            reach *= 1.0 - (stats["confident_rate"] if stage == "classifier" else stats["hit_rate"])
+        return cost
+
+    def reset(self):
+        with self.lock:
+            self.stages = {}
+
+# ----------------------------
+# Categorizer: configuration plus lazily loaded labels and models
+# ----------------------------
+class Categorizer:
+    def __init__(self, detection_model_path=None, classifier_model_path=None, mapping_json_path=None,
+                 coco_labels_path=None, imagenet_class_index_path=None, categorized_json_path=None,
+                 checkpoint_path=None, result_cache_path=None, result_store_path=None,
+                 use_tflite_runtime=True, top_k=CLASSIFIER_TOP_K, num_threads=None,
+                 cascade_order=CASCADE_STAGES, classifier_exit_threshold=0.8, prefilter_model_path=None,
+                 prefilter_threshold=0.1, embeddings_path=None, store_embeddings=False, embedding_tensor=None,
+                 use_result_cache=True):
+        # Nothing is read or loaded here; every model and label file is loaded on first use
+        self.config = {
+            "detection_model_path": detection_model_path or DETECTION_MODEL_PATH,
+            "classifier_model_path": classifier_model_path or CLASSIFIER_MODEL_PATH,
+            "mapping_json_path": mapping_json_path or MAPPING_JSON_PATH,
+            "coco_labels_path": coco_labels_path or COCO_LABELS_PATH,
+            "imagenet_class_index_path": imagenet_class_index_path or IMAGENET_CLASS_INDEX_PATH,
+            "categorized_json_path": categorized_json_path or CATEGORIZED_JSON_PATH,
+            "checkpoint_path": checkpoint_path or CHECKPOINT_PATH,
+            "result_cache_path": result_cache_path or RESULT_CACHE_PATH,
+            "use_result_cache": use_result_cache,  # False: never read or write the content-hash result cache
+            "result_store_path": result_store_path or RESULT_STORE_PATH,
+            "use_tflite_runtime": use_tflite_runtime,
+            "top_k": top_k,
+            "num_threads": num_threads,  # intra-op threads per interpreter (None keeps the TFLite default)
+            # Cascade policy: stage order, the fused category score at which a classifier-first cascade stops
+            # early, and an optional tiny model whose low scores let images skip the detector
+            "cascade_order": tuple(cascade_order),
+            "classifier_exit_threshold": classifier_exit_threshold,
+            "prefilter_model_path": prefilter_model_path,
+            "prefilter_threshold": prefilter_threshold,
+            # With store_embeddings the classifier runs on every image and process_folder keeps its features.
+            # embedding_tensor names the classifier's pooled penultimate tensor; None finds it by shape.
+            "embeddings_path": embeddings_path or EMBEDDINGS_PATH,
+            "store_embeddings": store_embeddings,
+            "embedding_tensor": embedding_tensor,
+        }
+        if sorted(self.config["cascade_order"]) != sorted(CASCADE_STAGES):
+            raise ValueError(f"cascade_order must order the stages {CASCADE_STAGES}, got {cascade_order}")
+        for name, value in self.config.items():
+            setattr(self, name, value)
+        self.cascade_stats = CascadeStats()
+        # Input/output tensor details per interpreter, refreshed only when its batch size changes
+        self.tensor_details_cache = {}
+
+    # ----------------------------
+    # Lazily loaded labels and mapping
+    # ----------------------------
+    @cached_property
+    def mapping_dict(self):
+        with open(self.mapping_json_path, 'r') as f:
+            mapping_dict = json.load(f)
+        for key in mapping_dict:
+            mapping_dict[key] = [s.lower() for s in mapping_dict[key]]
+        return mapping_dict
+
+    @cached_property
+    def label_to_category(self):
+        return build_label_index(self.mapping_dict)
+
+    @cached_property
+    def coco_labels(self):
+        # For detection, load the COCO labels (assumed one label per line)
+        with open(self.coco_labels_path, 'r') as f:
+            return [line.strip().lower() for line in f.readlines()]
+
+    @cached_property
+    def detector_category_codes(self):
+        # Maps a COCO class id to its index in DETECTOR_CATEGORIES (0 for no category)
+        coco_categories = [self.label_to_category.get(normalize_label(label)) for label in self.coco_labels]
+        return np.array(
+            [DETECTOR_CATEGORIES.index(c) if c in DETECTOR_CATEGORIES else 0 for c in coco_categories],
+            dtype=np.int8,
+        )
+
+    @cached_property
+    def imagenet_labels(self):
+        return load_imagenet_labels(self.imagenet_class_index_path)
+
+    @cached_property
+    def category_fusion(self):
+        # (classes x categories) one-hot matrix; classes without a mapping have an all-zero row, so they
+        # never outvote a mapped class (fuse_category_scores falls back to "Others" when nothing mapped scores)
+        fused_categories = CATEGORIES + sorted(set(self.label_to_category.values()) - set(CATEGORIES))
+        column = {category: i for i, category in enumerate(fused_categories)}
+        matrix = np.zeros((len(self.imagenet_labels), len(fused_categories)), dtype=np.float32)
+        for i, label in enumerate(self.imagenet_labels):
+            category = self.label_to_category.get(normalize_label(label))
+            if category is not None:
+                matrix[i, column[category]] = 1.0
+        return fused_categories, matrix
+
+    @property
+    def fused_categories(self):
+        return self.category_fusion[0]
+
+    @property
+    def category_matrix(self):
+        return self.category_fusion[1]
+
+    @cached_property
+    def model_fingerprint(self):
+        # Model identity: a change to either model, the mapping or the labels invalidates cached results,
+        # as do the classifier's top_k and a cascade policy other than the default one (both can change
+        # the chosen category)
+        paths = [self.detection_model_path, self.classifier_model_path, self.mapping_json_path, self.coco_labels_path]
+        if self.prefilter_model_path:
+            paths.append(self.prefilter_model_path)
+        fingerprint = f"{fingerprint_files(paths)}-top{self.top_k}"
+        if self.cascade_order != CASCADE_STAGES or self.prefilter_model_path:
+            fingerprint += f"-{'-'.join(self.cascade_order)}-{self.classifier_exit_threshold}-{self.prefilter_threshold}"
+        return fingerprint
+
+    # ----------------------------
+    # Lazily loaded TFLite models
+    # ----------------------------
+    def load_interpreter(self, model_path, **options):
+        interpreter = interpreter_class(self.use_tflite_runtime)(
+            model_path=model_path, num_threads=self.num_threads, **options
+        )
+        interpreter.allocate_tensors()
+        return interpreter
+
+    @cached_property
+    def detector(self):
+        return self.load_interpreter(self.detection_model_path)
+
+    @cached_property
+    def classifier(self):
+        if self.store_embeddings:
+            # Intermediate tensors are only readable after invoke() when the interpreter keeps them
+            return self.load_interpreter(self.classifier_model_path, experimental_preserve_all_tensors=True)
+        return self.load_interpreter(self.classifier_model_path)
+
+    @cached_property
+    def embedding_details(self):
+        # The pooled feature vector feeding the classifier's logits, not the class scores themselves
+        tensors = self.classifier.get_tensor_details()
+        if self.embedding_tensor:
+            for details in tensors:
+                if details['name'] == self.embedding_tensor:
+                    return details
+            raise ValueError(f"Classifier has no tensor named {self.embedding_tensor!r}")
+        # Otherwise the last per-image feature tensor: (batch, features) or (batch, 1, 1, features),
+        # excluding anything as wide as the class scores (the logits and their reshapes)
+        batch_size = self.tensor_details(self.classifier)["input"]['shape'][0]
+        classes = self.tensor_details(self.classifier)["outputs"][0]['shape'][-1]
+        candidates = [
+            details for details in tensors
+            if len(details['shape']) in (2, 4) and details['shape'][0] == batch_size
+            and all(size == 1 for size in details['shape'][1:-1]) and details['shape'][-1] not in (classes, 0)
+        ]
+        if not candidates:
+            raise ValueError("Could not find the classifier's pooled feature tensor; "
+                             "pass embedding_tensor with its name")
+        return max(candidates, key=lambda details: details['index'])
+
+    @cached_property
+    def result_cache(self):
+        # The content-hash cache shared by every entry point, opened on first use; its tail is flushed at exit
+        if not self.use_result_cache:
+            return None
+        cache = ResultCache(self.result_cache_path)
+        atexit.register(cache.flush)
+        return cache
+
+    @cached_property
+    def detector_max_batch(self):
+        # None when the detector takes any batch size, 1 when it only runs single images. The stock SSD model
+        # ends in TFLite_Detection_PostProcess, whose kernel only supports batch 1 and fails to allocate otherwise.
+        details = self.tensor_details(self.detector)
+        input_shape = list(details["input"]['shape'])
+        try:
+            self.set_batch_size(self.detector, 2)
+            outputs = self.tensor_details(self.detector)["outputs"]
+            batched = all(int(output['shape'][0]) == 2 for output in outputs if len(output.get('shape', ())))
+        except (RuntimeError, ValueError):
+            batched = False
+        # Back to the original shape, also when allocation failed half way
+        self.detector.resize_tensor_input(details["input"]['index'], input_shape)
+        self.detector.allocate_tensors()
+        self.tensor_details_cache.pop(id(self.detector), None)
+        return None if batched else 1
+
+    @cached_property
+    def prefilter(self):
+        return self.load_interpreter(self.prefilter_model_path) if self.prefilter_model_path else None
+
+    @cached_property
+    def classifier_lut(self):
+        return classifier_input_lut(self.tensor_details(self.classifier)["input"])
+
+    @cached_property
+    def prefilter_lut(self):
+        return classifier_input_lut(self.tensor_details(self.prefilter)["input"])
+
+    # ----------------------------
+    # Tensor access: cached details and in-place views into the interpreter's own buffers
+    # ----------------------------
+    def tensor_details(self, interpreter):
+        key = id(interpreter)
+        if key not in self.tensor_details_cache:
+            input_details = interpreter.get_input_details()[0]
+            self.tensor_details_cache[key] = {
+                "batch": int(input_details['shape'][0]),
+                "input": input_details,
+                "outputs": interpreter.get_output_details(),
+            }
+        return self.tensor_details_cache[key]
+
+    def set_batch_size(self, interpreter, batch_size):
+        # Resize the input tensor to the requested batch size, only reallocating when it changes
+        details = self.tensor_details(interpreter)
+        if details["batch"] == batch_size:
+            return
+        new_shape = list(details["input"]['shape'])
+        new_shape[0] = batch_size
+        interpreter.resize_tensor_input(details["input"]['index'], new_shape)
+        interpreter.allocate_tensors()
+        del self.tensor_details_cache[id(interpreter)]
+
+    def input_size(self, interpreter):
+        shape = self.tensor_details(interpreter)["input"]['shape']
+        return (int(shape[1]), int(shape[2]))
+
+    def fill_input(self, interpreter, images, preprocess):
+        # preprocess(image, out=row) writes each image straight into the input tensor.
+        # The view must be released before invoke(), which refuses to run while one is alive.
+        self.set_batch_size(interpreter, len(images))
+        input_view = interpreter.tensor(self.tensor_details(interpreter)["input"]['index'])()
+        for row, image in enumerate(images):
+            preprocess(image, out=input_view[row])
+        del input_view
+
+    def load_input(self, interpreter, batch):
+        # Copies an already preprocessed (batch, h, w, 3) array into the input tensor
+        self.set_batch_size(interpreter, len(batch))
+        input_view = interpreter.tensor(self.tensor_details(interpreter)["input"]['index'])()
+        input_view[...] = batch
+        del input_view
+
+    def read_output(self, interpreter, output, columns=None):
+        # Copies only the wanted part of an output tensor (all of it, or its leading columns)
+        output_index = self.tensor_details(interpreter)["outputs"][output]['index']
+        output_view = interpreter.tensor(output_index)()
+        return np.array(output_view if columns is None else output_view[:, :columns])
+
+    def fill_detector_input(self, images, resample=Image.Resampling.LANCZOS):
+        det_input_size = self.input_size(self.detector)
+        self.fill_input(self.detector, images,
+                        lambda image, out: preprocess_image_for_detector(image, det_input_size, resample, out))
+
+    def fill_classifier_input(self, images, resample=Image.Resampling.LANCZOS):
+        cls_input_size = self.input_size(self.classifier)
+        cls_lut = self.classifier_lut
+        self.fill_input(self.classifier, images,
+                        lambda image, out: preprocess_image_for_classifier(image, cls_input_size, resample, cls_lut, out))
+
+    def largest_input_size(self):
+        det_input_size = self.input_size(self.detector)
+        cls_input_size = self.input_size(self.classifier)
+        return (max(det_input_size[0], cls_input_size[0]), max(det_input_size[1], cls_input_size[1]))
+
+    def decode_size(self, fast_decode=True):
+        # Smallest decode size that still covers the largest model input, or None for a full decode
+        return self.largest_input_size() if fast_decode else None
+
+    # ----------------------------
+    # Mapping predictions to categories
+    # ----------------------------
+    def map_prediction_to_category(self, pred_label, mapping=None):
+        # Lookups go through the prebuilt index; a custom mapping gets its own index built on the fly
+        if mapping is None or mapping is self.mapping_dict:
+            label_index = self.label_to_category
+        else:
+            label_index = build_label_index(mapping)
+        return label_index.get(normalize_label(pred_label), 'Others')
+
+    def dequantize_output(self, preds, output_details):
+        # Quantized models emit uint8 scores; map them back to probabilities
+        scale, zero_point = output_details.get('quantization', (0.0, 0))
+        preds = preds.astype(np.float32)
+        if scale:
+            preds = (preds - zero_point) * scale
+        # Some MobileNet exports prepend a background class
+        if preds.shape[1] == len(self.imagenet_labels) + 1:
+            preds = preds[:, 1:]
+        return preds
+
+    def fuse_category_scores(self, probs, top_k=None):
+        # probs is (batch, classes); keeps each row's top_k probabilities and sums the mapped ones per category.
+        # A row whose top_k holds no mapped class is "Others", scored with its top_k probability mass.
+        # Returns (batch, categories) scores; top_k=1 reproduces the old top-1 label decision.
+        top_k = top_k or self.top_k
+        if top_k < probs.shape[1]:
+            top_idx = np.argpartition(probs, -top_k, axis=1)[:, -top_k:]
+            kept = np.zeros_like(probs)
+            np.put_along_axis(kept, top_idx, np.take_along_axis(probs, top_idx, axis=1), axis=1)
+            probs = kept
+        scores = probs @ self.category_matrix
+        unmapped = ~scores.any(axis=1)
+        scores[unmapped, self.fused_categories.index('Others')] = probs[unmapped].sum(axis=1)
+        return scores
+
+    def detections_to_categories(self, class_ids, scores, confidence_threshold=0.35):
+        # class_ids and scores are (batch, boxes) detector outputs.
+        # Returns the category of the first confident detection that maps to "Docs" or "People" for each
+        # image (None if there is none), and that detection's box index (-1 if there is none).
+        category_codes = self.detector_category_codes
+        codes = category_codes[np.clip(class_ids.astype(np.int64), 0, len(category_codes) - 1)]
+        hits = (scores >= confidence_threshold) & (codes > 0)
+        has_hit = hits.any(axis=1)
+        winning_boxes = np.where(has_hit, hits.argmax(axis=1), -1)
+        winning_codes = np.where(has_hit, codes[np.arange(len(codes)), np.maximum(winning_boxes, 0)], 0)
+        return [DETECTOR_CATEGORIES[code] for code in winning_codes], winning_boxes
+
+    # ----------------------------
+    # Inference stages on preprocessed tensors
+    # ----------------------------
+    def run_detector(self, det_input, confidence_threshold=0.35):
+        # det_input is a preprocessed (batch, h, w, 3) array
+        self.load_input(self.detector, det_input)
+        return self.invoke_detector(confidence_threshold)
+
+    def invoke_detector(self, confidence_threshold=0.35):
+        # Runs the detector on its filled input tensor.
+        # Returns "Docs"/"People"/None per image, plus the top detection and winning box of each image as raw scores.
+        self.detector.invoke()
+
+        # Boxes (output 0) are never needed, so only class ids and scores are copied out
+        class_ids = self.read_output(self.detector, 1)
+        scores = self.read_output(self.detector, 2)
+        categories, winning_boxes = self.detections_to_categories(class_ids, scores, confidence_threshold)
+        raw_scores = [
+            {
+                "detector_label": self.coco_labels[int(class_ids[i][0])],
+                "detector_score": float(scores[i][0]),
+                "detector_box": int(winning_boxes[i]),
+            }
+            for i in range(len(class_ids))
+        ]
+        return categories, raw_scores
+
+    def run_classifier(self, cls_input, top_k=None):
+        # cls_input is a preprocessed (batch, h, w, 3) array
+        self.load_input(self.classifier, cls_input)
+        return self.invoke_classifier(top_k)
+
+    def invoke_classifier(self, top_k=None):
+        # Runs the classifier on its filled input tensor; returns one category per image plus the
+        # top-1 label and the fused per-category scores
+        self.classifier.invoke()
+
+        output_details = self.tensor_details(self.classifier)["outputs"][0]
+        probs = self.dequantize_output(self.read_output(self.classifier, 0), output_details)
+        category_scores = self.fuse_category_scores(probs, top_k)
+        best_categories = category_scores.argmax(axis=1)
+        top_classes = probs.argmax(axis=1)
+
+        fused_categories = self.fused_categories
+        categories = [fused_categories[i] for i in best_categories]
+        raw_scores = [
+            {
+                "classifier_label": self.imagenet_labels[top_classes[row]],
+                "classifier_score": float(probs[row, top_classes[row]]),
+                "category_scores": {fused_categories[i]: float(score) for i, score in enumerate(category_scores[row])},
+            }
+            for row in range(len(probs))
+        ]
+        return categories, raw_scores
+
+    def read_embeddings(self, count):
+        # L2-normalised float32 feature rows of the classifier's last invoke
+        details = self.embedding_details
+        output_view = self.classifier.tensor(details['index'])()
+        embeddings = output_view.reshape(count, -1).astype(np.float32)
+        del output_view
+        scale, zero_point = details.get('quantization', (0.0, 0))
+        if scale:
+            embeddings = (embeddings - zero_point) * scale
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+    def fill_prefilter_input(self, images, resample=Image.Resampling.LANCZOS):
+        prefilter_input_size = self.input_size(self.prefilter)
+        prefilter_lut = self.prefilter_lut
+        self.fill_input(self.prefilter, images,
+                        lambda image, out: preprocess_image_for_classifier(image, prefilter_input_size, resample,
+                                                                           prefilter_lut, out))
+
+    def invoke_prefilter(self, count):
+        # The pre-filter is a small MobileNet-style model scoring how likely an image holds something the
+        # detector resolves (people or documents); returns one score per image
+        self.prefilter.invoke()
+        output_details = self.tensor_details(self.prefilter)["outputs"][0]
+        scores = self.read_output(self.prefilter, 0).astype(np.float32)
+        scale, zero_point = output_details.get('quantization', (0.0, 0))
+        if scale:
+            scores = (scores - zero_point) * scale
+        return scores.reshape(count, -1).max(axis=1)
+
+    # ----------------------------
+    # Early-exit cascade over downscaled images
+    # ----------------------------
+    def cascade(self, images, confidence_threshold=0.35, resample=Image.Resampling.LANCZOS):
+        fill_stage = {
+            "prefilter": self.fill_prefilter_input,
+            "detector": self.fill_detector_input,
+            "classifier": self.fill_classifier_input,
+        }
+        return self.run_cascade(
+            len(images), lambda stage, batch: fill_stage[stage]([images[i] for i in batch], resample),
+            confidence_threshold
+        )
+
+    def run_cascade(self, count, fill, confidence_threshold=0.35):
+        # fill(stage, indices) writes the inputs of those images into the stage's input tensor.
+        # Runs the stages in cascade_order, each only on the images no earlier stage resolved.
+        # The detector resolves an image when it finds Docs/People; the classifier resolves it when it runs
+        # last, or, when it runs first, once its fused category score reaches classifier_exit_threshold.
+        # Returns (categories, raw_scores) lists; per-stage hit rates are recorded in cascade_stats.
+        # With store_embeddings the classifier also runs on images already resolved, and each image's
+        # raw scores carry its "embedding" array.
+        categories = [None] * count
+        raw_scores = [{} for _ in range(count)]
+        pending = list(range(count))
+        classifier_fallback = {}  # classifier answers kept until the detector has had its turn
+        skip_detector = set()
+
+        if self.prefilter is not None:
+            start = time.perf_counter()
+            fill("prefilter", pending)
+            prefilter_scores = self.invoke_prefilter(count)
+            skip_detector = {i for i in pending if prefilter_scores[i] < self.prefilter_threshold}
+            for i in pending:
+                raw_scores[i]["prefilter_score"] = float(prefilter_scores[i])
+            self.cascade_stats.record("prefilter", count, len(skip_detector), time.perf_counter() - start)
+
+        for position, stage in enumerate(self.cascade_order):
+            last_stage = position == len(self.cascade_order) - 1
+            if stage == "detector":
+                batch = [i for i in pending if i not in skip_detector]
+            elif self.store_embeddings:
+                batch = list(range(count))
+            else:
+                batch = pending
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            if stage == "detector":
+                stage_categories, stage_scores = self.detect(batch, fill, confidence_threshold)
+            else:
+                fill(stage, batch)
+                stage_categories, stage_scores = self.invoke_classifier()
+                if self.store_embeddings:
+                    for i, embedding in zip(batch, self.read_embeddings(len(batch))):
+                        raw_scores[i]["embedding"] = embedding
+
+            resolved = set()
+            unresolved = set(pending)
+            confident = 0
+            for i, category, scores in zip(batch, stage_categories, stage_scores):
+                if stage == "classifier" and scores["category_scores"][category] >= self.classifier_exit_threshold:
+                    confident += 1
+                if i not in unresolved:
+                    continue
+                raw_scores[i].update(scores)
+                if stage == "detector":
+                    if category is not None:
+                        categories[i] = category
+                        resolved.add(i)
+                elif last_stage or scores["category_scores"][category] >= self.classifier_exit_threshold:
+                    categories[i] = category
+                    resolved.add(i)
+                else:
+                    classifier_fallback[i] = category
+            self.cascade_stats.record(stage, len(batch), len(resolved), time.perf_counter() - start, confident)
+            pending = [i for i in pending if i not in resolved]
+
+        # Images the detector ran on without finding Docs/People keep the classifier's answer
+        for i in pending:
+            categories[i] = classifier_fallback[i]
+        return categories, raw_scores
+
+    def detect(self, batch, fill, confidence_threshold=0.35):
+        # One detector invoke for the batch, or one per image for a detector limited to batch 1
+        step = self.detector_max_batch or len(batch)
+        categories, raw_scores = [], []
+        for start in range(0, len(batch), step):
+            fill("detector", batch[start:start + step])
+            step_categories, step_scores = self.invoke_detector(confidence_threshold)
+            categories.extend(step_categories)
+            raw_scores.extend(step_scores)
+        return categories, raw_scores
+
+    # ----------------------------
+    # Hybrid pipeline function (original approach)
+    # ----------------------------
+    def hybrid_pipeline(self, image_path, confidence_threshold=0.35, fast_decode=True,
+                        resample=Image.Resampling.LANCZOS, cache=None):
+        # Consult the result cache first: the one given, or else the Categorizer's own result_cache
+        if cache is None:
+            cache = self.result_cache
+        if cache is not None:
+            key = self.cache_key(image_path, confidence_threshold, fast_decode, resample)
+            cached = cache.get(key)
+            if cached is not None:
+                cache.commit()
+                return cached[0]
+
+        category, raw_scores = self.classify_image_path(image_path, confidence_threshold, fast_decode, resample)
+        if cache is not None:
+            cache.put(key, category, {name: score for name, score in raw_scores.items() if name != "embedding"})
+            cache.commit()
+        return category
+
+    def prepare_image(self, image_path, fast_decode=True, resample=Image.Resampling.LANCZOS):
+        # Decodes and downscales once to the largest model input; returns (image, filter for the per-model resizes)
+        image = load_image(image_path, self.decode_size(fast_decode))
+        return downscale_for_models(image, self.largest_input_size(), resample)
+
+    def classify_image_path(self, image_path, confidence_threshold=0.35, fast_decode=True,
+                            resample=Image.Resampling.LANCZOS):
+        # Returns (category, raw_scores) for a single image file
+        image, resample = self.prepare_image(image_path, fast_decode, resample)
+        return self.classify_image(image, confidence_threshold, resample)
+
+    def classify_image(self, image, confidence_threshold=0.35, resample=Image.Resampling.LANCZOS):
+        # Returns (category, raw_scores) for an image prepare_image already returned
+        categories, raw_scores = self.cascade([image], confidence_threshold, resample)
+        return categories[0], raw_scores[0]
+
+    # ----------------------------
+    # Batched hybrid pipeline (one classifier invoke per batch; one detector invoke per batch, or per image
+    # with a detector that only supports batch 1 such as the stock SSD model)
+    # ----------------------------
+    def hybrid_pipeline_batch(self, image_paths, batch_size=32, confidence_threshold=0.35, fast_decode=True,
+                              resample=Image.Resampling.LANCZOS):
+        image_paths = list(image_paths)
+        draft_size = self.decode_size(fast_decode)
+        categories = []
+        for start in range(0, len(image_paths), batch_size):
+            batch_paths = image_paths[start:start + batch_size]
+            images = [load_image(path, draft_size) for path in batch_paths]
+            categories.extend(self.classify_image_batch(images, confidence_threshold, resample))
+        return categories
+
+    def classify_image_batch(self, images, confidence_threshold=0.35, resample=Image.Resampling.LANCZOS):
+        shared_size = self.largest_input_size()
+        downscaled = [downscale_for_models(image, shared_size, resample) for image in images]
+        images = [image for image, _ in downscaled]
+        resample = downscaled[0][1]
+        # One invoke per stage for the whole batch (per image for a batch-1 detector), each only on images
+        # earlier stages left unresolved
+        return self.cascade(images, confidence_threshold, resample)[0]
+
+    # ----------------------------
+    # Result cache key
+    # ----------------------------
+    def cache_key(self, image_path, confidence_threshold=0.35, fast_decode=True, resample=Image.Resampling.LANCZOS):
+        # Decode and resampling options change the model inputs, so results computed with other ones are not reused
+        preprocessing = f"{'draft' if fast_decode else 'full'}-{getattr(resample, 'name', resample)}"
+        return f"{fingerprint_files([image_path])}:{self.model_fingerprint}:{confidence_threshold}:{preprocessing}"
+
+    # ----------------------------
+    # Resampling accuracy check against per-model LANCZOS resizing
+    # ----------------------------
+    def measure_resample_drift(self, labelled_data, resample=Image.Resampling.BILINEAR, confidence_threshold=0.35,
+                               fast_decode=True):
+        # labelled_data uses the categorized.json layout: {"Docs": [paths], "People": [paths], ...}
+        total = reference_correct = correct = agreed = 0
+        for expected_category, image_paths in labelled_data.items():
+            for image_path in image_paths:
+                reference = self.hybrid_pipeline(image_path, confidence_threshold, fast_decode, resample=None)
+                category = self.hybrid_pipeline(image_path, confidence_threshold, fast_decode, resample)
+                total += 1
+                reference_correct += reference == expected_category
+                correct += category == expected_category
+                agreed += category == reference
+
+        if total == 0:
+            return {"samples": 0}
+        return {
+            "samples": total,
+            "reference_accuracy": reference_correct / total,
+            "accuracy": correct / total,
+            "accuracy_drift": (correct - reference_correct) / total,
+            "agreement": agreed / total,
+        }
+
+    # ----------------------------
+    # Batch processing for folder with checkpointing
+    # ----------------------------
+    def process_folder(self, folder_path, confidence_threshold=0.35, workers=1, fast_decode=True,
+                       resample=Image.Resampling.LANCZOS, use_cache=True, commit_every=100, export_json=False,
+                       interpreter_pool=None, duplicate_distance=None, recursive=True, scan_chunk=512,
+                       process_pool=None, duplicate_index=None):
+        # workers > 1 classifies in that many processes; an InterpreterPool classifies on its threads instead.
+        # A caller-owned process_pool (see open_worker_pool) and duplicate_index are used and left open.
+        # With duplicate_distance, an image within that many hash bits of an already categorized one
+        # takes its category without running the models.
+        # The folder (and, with recursive, its subfolders) is walked lazily and categorized scan_chunk
+        # pending files at a time, so classification starts long before a large folder is fully listed.
+
+        # The store doubles as the checkpoint: every commit_every images the categories and the mtime of
+        # each finished file are committed atomically, so a crash only loses the uncommitted tail
+        store = open_result_store(self.result_store_path, commit_every, self.categorized_json_path)
+        completed = store.completed_files()
+
+        # Legacy max-mtime checkpoint, only used for rows imported from categorized.json
+        last_timestamp = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as f:
+                try:
+                    last_timestamp = float(f.read().strip())
+                except ValueError:
+                    last_timestamp = 0
+
+        own_process_pool = process_pool is None and workers > 1 and interpreter_pool is None
+        if own_process_pool:
+            process_pool = open_worker_pool(self.config, workers)
+        if duplicate_distance is not None and duplicate_index is None:
+            duplicate_index = build_duplicate_index(store)
+        embeddings = EmbeddingStore(self.embeddings_path) if self.store_embeddings else None
+        cache = self.result_cache if use_cache else None
+        try:
+            # Skip files already categorized at their current mtime; new, changed and late-arriving files remain,
+            # as do (with store_embeddings) categorized files that have no stored embedding yet
+            pending_files = []
+            for image_file, image_path, mod_time in iter_image_files(folder_path, recursive):
+                if image_path in completed and (embeddings is None or image_path in embeddings):
+                    completed_mtime = completed[image_path]
+                    if completed_mtime == mod_time or (completed_mtime is None and mod_time <= last_timestamp):
+                        continue
+                # Only files that are actually pending are opened, so a resume stays O(remaining files)
+                if not has_image_signature(image_path):
+                    continue
+                pending_files.append((image_file, image_path, mod_time))
+                if len(pending_files) >= scan_chunk:
+                    self.categorize_files(store, pending_files, confidence_threshold, workers, fast_decode, resample,
+                                          use_cache, interpreter_pool, duplicate_distance, process_pool,
+                                          duplicate_index, embeddings, cache)
+                    pending_files = []
+            self.categorize_files(store, pending_files, confidence_threshold, workers, fast_decode, resample,
+                                  use_cache, interpreter_pool, duplicate_distance, process_pool, duplicate_index,
+                                  embeddings, cache)
+        finally:
+            if own_process_pool:
+                process_pool.shutdown()
+            if embeddings is not None:
+                embeddings.close()
+            if cache is not None:
+                cache.flush()
+            # Save updated categorized data (also on failure, so the run can resume from here)
+            store.commit()
+            print(f"Categorized data saved to: {self.result_store_path}")
+            if export_json:
+                store.export_json(self.categorized_json_path)
+                print(f"Legacy categorized JSON exported to: {self.categorized_json_path}")
+            store.close()
+
+    def categorize_files(self, store, pending_files, confidence_threshold=0.35, workers=1, fast_decode=True,
+                         resample=Image.Resampling.LANCZOS, use_cache=True, interpreter_pool=None,
+                         duplicate_distance=None, process_pool=None, duplicate_index=None, embeddings=None,
+                         cache=None):
+        # Categorizes pending_files ([(image_file, image_path, mtime)]) into an open store and commits it.
+        # Callers categorizing several chunks pass one process_pool, duplicate_index and (with store_embeddings)
+        # open EmbeddingStore for all of them; the result cache defaults to the Categorizer's result_cache.
+
+        # Consult the result cache first; duplicate photos share a cache key and are classified once.
+        # When embeddings are stored, images without a stored embedding still go through the models.
+        if cache is None and use_cache:
+            cache = self.result_cache
+        own_embeddings = embeddings is None and self.store_embeddings
+        if own_embeddings:
+            embeddings = EmbeddingStore(self.embeddings_path)
+        # A file that cannot be read or classified is logged and left out of the store, so the run goes on
+        # and the next run (or, in watch mode, the next change to the file) tries it again
+        failed = {}  # image_path -> error
+        keys = []
+        for _, image_path, _ in pending_files:
+            try:
+                keys.append(self.cache_key(image_path, confidence_threshold, fast_decode, resample)
+                            if cache is not None else image_path)
+            except OSError as error:
+                failed[image_path] = error
+                keys.append(image_path)
+        results = {}  # key -> (category, raw_scores)
+        if cache is not None:
+            for key, (_, image_path, _) in zip(keys, pending_files):
+                if key not in results and image_path not in failed and (embeddings is None or image_path in embeddings):
+                    cached = cache.get(key)
+                    if cached is not None:
+                        results[key] = cached
+
+        # Near-duplicates of stored images, or of earlier files in this run, reuse their category.
+        # Each image is decoded once: the hash comes from the downscaled model input, which is kept
+        # for inference (at most one chunk of them) unless the image turns out to be a near-duplicate.
+        phashes = {}
+        near_duplicates = {}  # image_path -> path of the near-duplicate whose category it takes
+        prepared = {}  # image_path -> downscaled image awaiting inference
+        if duplicate_distance is not None and duplicate_index is None:
+            duplicate_index = build_duplicate_index(store)
+        tree, known_categories = duplicate_index or (None, {})
+        if duplicate_distance is not None:
+            for key, (_, image_path, _) in zip(keys, pending_files):
+                if image_path in failed:
+                    continue
+                try:
+                    image, _ = self.prepare_image(image_path, fast_decode, resample)
+                except IMAGE_ERRORS as error:
+                    failed[image_path] = error
+                    continue
+                phashes[image_path] = perceptual_hash(image)
+                if key not in results:
+                    match = tree.nearest(phashes[image_path], duplicate_distance)
+                    if match is not None and match != image_path:
+                        near_duplicates[image_path] = match
+                    elif resample is not None:
+                        # resample=None leaves the image at full size, too large to hold for a whole chunk
+                        prepared[image_path] = image
+                tree.add(phashes[image_path], image_path)
+
+        # Keys still to classify, in first-seen order; results are consumed lazily in that same order
+        uncached = {}
+        for key, (_, image_path, _) in zip(keys, pending_files):
+            if key not in results and image_path not in near_duplicates and image_path not in failed:
+                uncached.setdefault(key, image_path)
+        # Classify the images hashing already prepared; if any is missing, decode them all from their paths
+        images = [prepared.pop(image_path, None) for image_path in uncached.values()]
+        prepared.clear()
+        if any(image is None for image in images):
+            images = None
+        uncached_paths = list(uncached.values())
+        classified = self.classify_pending(uncached_paths, images, confidence_threshold, workers, fast_decode,
+                                           resample, interpreter_pool, process_pool)
+        position = 0  # index into uncached_paths of the next result
+
+        try:
+            for (image_file, image_path, mod_time), key in zip(pending_files, keys):
+                if image_path in failed or key in failed:
+                    print(f"Skipped: {image_file} ({failed.get(image_path) or failed[key]})")
+                    continue
+                if image_path in near_duplicates and key not in results:
+                    match = near_duplicates[image_path]
+                    if match not in known_categories:
+                        print(f"Skipped: {image_file} (near-duplicate of {os.path.basename(match)}, "
+                              f"which could not be categorized)")
+                        continue
+                    category = known_categories[match]
+                    embedding = embeddings.vector(match) if embeddings is not None else None
+                    print(f"Processed: {image_file} -> Category: {category} (near-duplicate of "
+                          f"{os.path.basename(match)})")
+                else:
+                    if key not in results:
+                        position += 1
+                        try:
+                            results[key] = next(classified)
+                        except IMAGE_ERRORS as error:
+                            # The error ends the result stream; classify the files after this one afresh
+                            failed[key] = error
+                            classified = self.classify_pending(
+                                uncached_paths[position:], images and images[position:], confidence_threshold,
+                                workers, fast_decode, resample, interpreter_pool, process_pool
+                            )
+                            print(f"Skipped: {image_file} ({error})")
+                            continue
+                        if cache is not None:
+                            category, raw_scores = results[key]
+                            cache.put(key, category, {name: score for name, score in raw_scores.items()
+                                                      if name != "embedding"})
+                    category = results[key][0]
+                    embedding = results[key][1].get("embedding")
+                    print(f"Processed: {image_file} -> Category: {category}")
+                if embeddings is not None and embedding is not None:
+                    embeddings.add(image_path, embedding)
+                known_categories[image_path] = category
+                store.add(image_path, category, mod_time, phashes.get(image_path))
+        finally:
+            if cache is not None:
+                cache.flush()
+            if own_embeddings:
+                embeddings.close()
+            elif embeddings is not None:
+                embeddings.commit()
+            store.commit()
+
+    def classify_pending(self, image_paths, images, confidence_threshold=0.35, workers=1, fast_decode=True,
+                         resample=Image.Resampling.LANCZOS, interpreter_pool=None, process_pool=None):
+        # Yields (category, raw_scores) for each of image_paths in order, from images (the prepared
+        # images for those paths) when given rather than decoding the files again
+        if interpreter_pool is not None and images is not None:
+            return interpreter_pool.classify_images(images, confidence_threshold, resample)
+        if interpreter_pool is not None:
+            return interpreter_pool.classify_image_paths(image_paths, confidence_threshold, fast_decode, resample)
+        if workers > 1 and len(image_paths) > 1:
+            return classify_in_pool(
+                self.config, images or image_paths, workers, confidence_threshold, fast_decode, resample,
+                process_pool, prepared=images is not None
+            )
+        if images is not None:
+            return (self.classify_image(image, confidence_threshold, resample) for image in images)
+        return (
+            self.classify_image_path(image_path, confidence_threshold, fast_decode, resample)
+            for image_path in image_paths
+        )
+
+    # ----------------------------
+    # Watch mode: categorize new and changed files as they land
+    # ----------------------------
+    def watch_folder(self, folder_path, confidence_threshold=0.35, settle_seconds=2.0, poll_interval=5.0,
+                     stop_event=None, export_json=False, recursive=True, workers=1, fast_decode=True,
+                     resample=Image.Resampling.LANCZOS, use_cache=True, commit_every=100, interpreter_pool=None,
+                     duplicate_distance=None, scan_chunk=512):
+        # Catches up with a normal process_folder run, then only ever looks at files the watcher reports.
+        # One worker process pool and one near-duplicate index serve the catch-up run and every later batch,
+        # so the daemon never reloads its models.
+        # The watcher starts first so files landing during the catch-up run are not missed
+        watcher = FolderWatcher(folder_path, settle_seconds, poll_interval, recursive=recursive)
+        process_pool = open_worker_pool(self.config, workers) if workers > 1 and interpreter_pool is None else None
+        duplicate_index = None
+        if duplicate_distance is not None:
+            store = open_result_store(self.result_store_path, categorized_json_path=self.categorized_json_path)
+            try:
+                duplicate_index = build_duplicate_index(store)
+            finally:
+                store.close()
+        try:
+            self.process_folder(folder_path, confidence_threshold, workers, fast_decode, resample, use_cache,
+                                commit_every, export_json, interpreter_pool, duplicate_distance, recursive,
+                                scan_chunk, process_pool, duplicate_index)
+            print(f"Watching {folder_path} ({watcher.backend})")
+            for changed_paths in watcher.batches(stop_event):
+                store = open_result_store(self.result_store_path, commit_every, self.categorized_json_path)
+                try:
+                    completed = store.mtimes(changed_paths)
+                    pending_files = []
+                    for image_path in changed_paths:
+                        try:
+                            mod_time = os.path.getmtime(image_path)
+                        except OSError:
+                            continue  # removed again before it settled
+                        if completed.get(image_path) != mod_time and has_image_signature(image_path):
+                            pending_files.append((os.path.relpath(image_path, folder_path), image_path, mod_time))
+                    self.categorize_files(store, pending_files, confidence_threshold, workers, fast_decode, resample,
+                                          use_cache, interpreter_pool, duplicate_distance, process_pool,
+                                          duplicate_index)
+                    if export_json and pending_files:
+                        store.export_json(self.categorized_json_path)
+                finally:
+                    store.close()
+        finally:
+            if process_pool is not None:
+                process_pool.shutdown()
+            watcher.close()
+
+    def duplicate_clusters(self, max_distance=4):
+        # Groups of near-duplicate images among those process_folder hashed (run with duplicate_distance)
+        store = open_result_store(self.result_store_path, categorized_json_path=self.categorized_json_path)
+        try:
+            path_hashes = {image_path: phash for image_path, _, phash in store.hashes()}
+        finally:
+            store.close()
+        return duplicate_clusters(path_hashes, max_distance)
+
+    def similar_images(self, image_path, k=10):
+        # "More like this" over the embeddings process_folder stored (with store_embeddings=True).
+        # For many queries on a large collection, keep an EmbeddingStore open and call build_index() once.
+        embeddings = EmbeddingStore(self.embeddings_path)
+        try:
+            return embeddings.similar_to(image_path, k)
+        finally:
+            embeddings.close()
+
+# ----------------------------
+# Module-level API backed by a default Categorizer, created on first use
+# ----------------------------
+default_categorizer = None
+
+def get_default_categorizer():
+    global default_categorizer
+    if default_categorizer is None:
+        default_categorizer = Categorizer()
+    return default_categorizer
+
+def __getattr__(name):
+    # Keeps the old module globals (categorize.detector, categorize.mapping_dict, ...) working, lazily
+    if name in ("detector", "classifier", "mapping_dict", "coco_labels", "label_to_category"):
+        return getattr(get_default_categorizer(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def map_prediction_to_category(pred_label, mapping=None):
+    return get_default_categorizer().map_prediction_to_category(pred_label, mapping)
 
-    # Load checkpoint timestamp if exists
-    last_timestamp = 0
-    if os.path.exists(CHECKPOINT_PATH):
-        with open(CHECKPOINT_PATH, 'r') as f:
+def hybrid_pipeline(image_path, *args, **kwargs):
+    return get_default_categorizer().hybrid_pipeline(image_path, *args, **kwargs)
+
+def hybrid_pipeline_batch(image_paths, *args, **kwargs):
+    return get_default_categorizer().hybrid_pipeline_batch(image_paths, *args, **kwargs)
+
+def process_folder(folder_path, *args, **kwargs):
+    return get_default_categorizer().process_folder(folder_path, *args, **kwargs)
+
+def measure_resample_drift(labelled_data, *args, **kwargs):
+    return get_default_categorizer().measure_resample_drift(labelled_data, *args, **kwargs)
+
+def watch_folder(folder_path, *args, **kwargs):
+    return get_default_categorizer().watch_folder(folder_path, *args, **kwargs)
+
+# ----------------------------
+# Interpreter pool: N detector/classifier pairs with M threads each, checked out per request
+# ----------------------------
+# Loaded labels are shared by every pooled Categorizer; only the interpreters are per-pair
+SHARED_CATEGORIZER_STATE = ("mapping_dict", "label_to_category", "coco_labels", "detector_category_codes",
+                            "imagenet_labels", "category_fusion", "model_fingerprint")
+
+class PooledCategorizer(Categorizer):
+    # A pool member: its own interpreters, with the shared state read from the base Categorizer when first
+    # needed, so building a pool loads, hashes and downloads nothing
+    def __init__(self, base, **config):
+        super().__init__(**config)
+        self.base = base
+        self.cascade_stats = base.cascade_stats
+
+for name in SHARED_CATEGORIZER_STATE:
+    setattr(PooledCategorizer, name, property(lambda self, name=name: getattr(self.base, name)))
+
+class InterpreterPool:
+    def __init__(self, size=1, num_threads=None, categorizer=None):
+        base = categorizer or get_default_categorizer()
+        self.size = size
+        self.num_threads = num_threads or base.num_threads
+        self.config = {**base.config, "num_threads": self.num_threads}
+        self.idle = queue.Queue()
+        for _ in range(size):
+            self.idle.put(PooledCategorizer(base, **self.config))
+
+    @contextmanager
+    def checkout(self):
+        # A checked-out Categorizer (and its two interpreters) is used by one thread at a time
+        member = self.idle.get()
+        try:
+            yield member
+        finally:
+            self.idle.put(member)
+
+    def classify_image_path(self, image_path, confidence_threshold=0.35, fast_decode=True,
+                            resample=Image.Resampling.LANCZOS):
+        with self.checkout() as member:
+            return member.classify_image_path(image_path, confidence_threshold, fast_decode, resample)
+
+    def classify_image_paths(self, image_paths, confidence_threshold=0.35, fast_decode=True,
+                             resample=Image.Resampling.LANCZOS):
+        # Yields (category, raw_scores) in input order; TFLite releases the GIL while invoking,
+        # so one thread per pooled pair keeps every interpreter busy
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            yield from executor.map(
+                self.classify_image_path, image_paths, repeat(confidence_threshold), repeat(fast_decode),
+                repeat(resample)
+            )
+
+    def classify_image(self, image, confidence_threshold=0.35, resample=Image.Resampling.LANCZOS):
+        with self.checkout() as member:
+            return member.classify_image(image, confidence_threshold, resample)
+
+    def classify_images(self, images, confidence_threshold=0.35, resample=Image.Resampling.LANCZOS):
+        # Like classify_image_paths, for images prepare_image already returned
+        with ThreadPoolExecutor(max_workers=self.size) as executor:
+            yield from executor.map(self.classify_image, images, repeat(confidence_threshold), repeat(resample))
+
+def pool_shapes(cpu_count):
+    # Every (interpreters, threads per interpreter) split that uses all cores
+    return [(n, cpu_count // n) for n in range(1, cpu_count + 1) if cpu_count % n == 0]
+
+def tune_interpreter_pool(categorizer=None, cpu_count=None, objective="throughput", rounds=4, shapes=None):
+    # Times each N x M split on blank images and returns the fastest as
+    # {"size": N, "num_threads": M, "timings": {(N, M): seconds per image}}.
+    # objective="latency" times single requests on one interpreter; "throughput" keeps all N busy.
+    categorizer = categorizer or get_default_categorizer()
+    cpu_count = cpu_count or os.cpu_count() or 1
+    image = Image.new('RGB', categorizer.largest_input_size())
+    if shapes is None:
+        shapes = pool_shapes(cpu_count)
+        if objective == "latency":
+            shapes = [(1, threads) for _, threads in shapes]
+
+    def classify(pool):
+        with pool.checkout() as member:
+            member.classify_image_batch([image])
+
+    timings = {}
+    for size, num_threads in shapes:
+        pool = InterpreterPool(size, num_threads, categorizer)
+        requests = rounds * size
+        with ThreadPoolExecutor(max_workers=size) as executor:
+            list(executor.map(classify, repeat(pool, size)))  # warm-up: loads and allocates every interpreter
+            start = time.perf_counter()
+            list(executor.map(classify, repeat(pool, requests)))
+            timings[(size, num_threads)] = (time.perf_counter() - start) / requests
+
+    size, num_threads = min(timings, key=timings.get)
+    return {"size": size, "num_threads": num_threads, "timings": timings}
+
+def tuned_interpreter_pool(categorizer=None, cpu_count=None, objective="throughput"):
+    tuned = tune_interpreter_pool(categorizer, cpu_count, objective)
+    return InterpreterPool(tuned["size"], tuned["num_threads"], categorizer)
+
+# ----------------------------
+# Streaming pipeline: threaded decode/preprocess feeding a single inference stage
+# ----------------------------
+STREAM_END = object()
+
+class StreamingPipeline:
+    def __init__(self, decode_workers=4, queue_size=32, confidence_threshold=0.35, fast_decode=True,
+                 resample=Image.Resampling.LANCZOS, categorizer=None):
+        self.categorizer = categorizer or get_default_categorizer()
+        self.decode_workers = decode_workers
+        self.confidence_threshold = confidence_threshold
+        self.fast_decode = fast_decode
+        self.resample = resample
+        self.queue_size = queue_size
+        self.open_stream()
+
+    def open_stream(self):
+        # Bounded queues between stages: paths -> decode/preprocess -> inference.
+        # Every run gets its own, so nothing left over from an aborted run can leak into the next.
+        self.path_queue = queue.Queue(maxsize=self.queue_size)
+        self.ready_queue = queue.Queue(maxsize=self.queue_size)
+        self.stopped = threading.Event()
+        return self.path_queue, self.ready_queue, self.stopped
+
+    def queue_depths(self):
+        # A full decode queue means decoding is the bottleneck, a full ready queue means inference is
+        return {
+            "decode": self.path_queue.qsize(),
+            "inference": self.ready_queue.qsize(),
+        }
+
+    def put(self, target_queue, item, stopped):
+        # Block on a full queue, but give up once the consumer has stopped
+        while not stopped.is_set():
+            try:
+                target_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, source_queue, stopped):
+        # Block on an empty queue, but give up (returning STREAM_END) once the consumer has stopped
+        while not stopped.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return STREAM_END
+
+    def feed_paths(self, image_paths, path_queue, stopped):
+        for image_path in image_paths:
+            if not self.put(path_queue, image_path, stopped):
+                return
+        for _ in range(self.decode_workers):
+            self.put(path_queue, STREAM_END, stopped)
+
+    def decode_worker(self, path_queue, ready_queue, stopped, det_input_size, cls_input_size, shared_size,
+                      draft_size, cls_lut, prefilter_input_size=None, prefilter_lut=None):
+        while True:
+            image_path = self.get(path_queue, stopped)
+            if image_path is STREAM_END:
+                self.put(ready_queue, STREAM_END, stopped)
+                return
             try:
-                last_timestamp = float(f.read().strip())
-            except ValueError:
-                last_timestamp = 0
-
-    # Get all image files with their full paths and modification times
-    image_files = [
-        (f, os.path.getmtime(os.path.join(folder_path, f)))
-        for f in sorted(os.listdir(folder_path))
-        if f.lower().endswith(supported_formats)
-    ]
-
-    new_last_timestamp = last_timestamp
-    for image_file, mod_time in image_files:
-        if mod_time <= last_timestamp:
-            continue  # Skip already processed files
-
-        image_path = os.path.join(folder_path, image_file)
-        category = hybrid_pipeline(image_path, confidence_threshold)
-        categorized_data[category].append(image_path)
-        print(f"Processed: {image_file} -> Category: {category}")
-
-        # Update the most recent timestamp
-        if mod_time > new_last_timestamp:
-            new_last_timestamp = mod_time
-
-    # Save updated categorized data
-    with open(CATEGORIZED_JSON_PATH, "w") as json_file:
-        json.dump(categorized_data, json_file, indent=4)
-    print(f"Categorized data saved to: {CATEGORIZED_JSON_PATH}")
-
-    # Update checkpoint with latest timestamp
-    if new_last_timestamp > last_timestamp:
-        with open(CHECKPOINT_PATH, 'w') as f:
-            f.write(str(new_last_timestamp))
-        print(f"Checkpoint updated to timestamp: {new_last_timestamp} ({time.ctime(new_last_timestamp)})")
+                image = load_image(image_path, draft_size)
+                image, resample = downscale_for_models(image, shared_size, self.resample)
+                # Every model input is prepared here so the inference stage never touches PIL
+                inputs = {
+                    "detector": preprocess_image_for_detector(image, det_input_size, resample),
+                    "classifier": preprocess_image_for_classifier(image, cls_input_size, resample, cls_lut),
+                }
+                if prefilter_input_size is not None:
+                    inputs["prefilter"] = preprocess_image_for_classifier(
+                        image, prefilter_input_size, resample, prefilter_lut
+                    )
+                item = (image_path, inputs, None)
+            except Exception as e:
+                item = (image_path, None, e)
+            if not self.put(ready_queue, item, stopped):
+                return
+
+    def run(self, image_paths):
+        # Yields (image_path, category) in completion order
+        categorizer = self.categorizer
+        det_input_size = categorizer.input_size(categorizer.detector)
+        cls_input_size = categorizer.input_size(categorizer.classifier)
+        shared_size = categorizer.largest_input_size()
+        draft_size = categorizer.decode_size(self.fast_decode)
+        cls_lut = categorizer.classifier_lut
+        prefilter_input_size = prefilter_lut = None
+        if categorizer.prefilter is not None:
+            prefilter_input_size = categorizer.input_size(categorizer.prefilter)
+            prefilter_lut = categorizer.prefilter_lut
+        models = {"prefilter": categorizer.prefilter, "detector": categorizer.detector,
+                  "classifier": categorizer.classifier}
+
+        path_queue, ready_queue, stopped = self.open_stream()
+        threads = [threading.Thread(target=self.feed_paths, args=(image_paths, path_queue, stopped), daemon=True)]
+        threads += [
+            threading.Thread(target=self.decode_worker,
+                             args=(path_queue, ready_queue, stopped, det_input_size, cls_input_size,
+                                   shared_size, draft_size, cls_lut, prefilter_input_size, prefilter_lut),
+                             daemon=True)
+            for _ in range(self.decode_workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        try:
+            finished_workers = 0
+            while finished_workers < self.decode_workers:
+                item = ready_queue.get()
+                if item is STREAM_END:
+                    finished_workers += 1
+                    continue
+                image_path, inputs, error = item
+                if error is not None:
+                    raise error
+                categories, _ = categorizer.run_cascade(
+                    1, lambda stage, batch: categorizer.load_input(models[stage], inputs[stage]),
+                    self.confidence_threshold
+                )
+                yield image_path, categories[0]
+        finally:
+            # Stopping unblocks every put/get within a poll interval, so the stages always wind down
+            stopped.set()
+            for thread in threads:
+                thread.join()
+
+# ----------------------------
+# Content-hash result cache
+# ----------------------------
+class ResultCache:
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=500000, commit_every=256):
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        # WAL keeps readers in other processes unblocked and makes the per-call commits of hybrid_pipeline cheap;
+        # losing the last few entries on a crash only costs a recomputation
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, category TEXT NOT NULL, scores TEXT NOT NULL, last_used REAL NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)")
+        self.connection.commit()
+
+    def get(self, key):
+        # Returns (category, raw_scores) or None, and marks the entry as recently used
+        with self.lock:
+            row = self.connection.execute("SELECT category, scores FROM results WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key))
+            self.record_write()
+            return row[0], json.loads(row[1])
+
+    def put(self, key, category, raw_scores):
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, category, scores, last_used) VALUES (?, ?, ?, ?)",
+                (key, category, json.dumps(raw_scores), time.time()),
+            )
+            self.record_write()
+
+    def record_write(self):
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.evict()
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def evict(self):
+        # Drop the least recently used entries beyond max_entries
+        count = self.connection.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+        if count > self.max_entries:
+            self.connection.execute(
+                "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def commit(self):
+        # Ends the open transaction without the eviction pass, so single lookups don't hold the write lock
+        with self.lock:
+            self.connection.commit()
+
+    def flush(self):
+        with self.lock:
+            self.evict()
+            self.connection.commit()
+            self.pending_writes = 0
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+# ----------------------------
+# Indexed result store (replaces rewriting categorized.json on every run)
+# ----------------------------
+class ResultStore:
+    def __init__(self, path=RESULT_STORE_PATH, commit_every=100):
+        self.commit_every = commit_every
+        self.pending_writes = 0
+        self.connection = sqlite3.connect(path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS images ("
+            "path TEXT PRIMARY KEY, category TEXT NOT NULL, processed_at REAL NOT NULL, mtime REAL, phash INTEGER)"
+        )
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(images)")]
+        if "mtime" not in columns:
+            self.connection.execute("ALTER TABLE images ADD COLUMN mtime REAL")
+        if "phash" not in columns:
+            self.connection.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS images_category ON images (category)")
+        self.connection.commit()
+
+    def is_empty(self):
+        return self.connection.execute("SELECT 1 FROM images LIMIT 1").fetchone() is None
+
+    def add(self, image_path, category, mtime=None, phash=None):
+        # Re-categorizing a path replaces its previous entry instead of listing it twice.
+        # mtime records which version of the file was categorized, for checkpoint/resume.
+        # SQLite integers are signed 64-bit, so the 64-bit perceptual hash is stored two's-complement.
+        if phash is not None and phash >= 1 << 63:
+            phash -= 1 << 64
+        self.connection.execute(
+            "INSERT OR REPLACE INTO images (path, category, processed_at, mtime, phash) VALUES (?, ?, ?, ?, ?)",
+            (image_path, category, time.time(), mtime, phash),
+        )
+        self.pending_writes += 1
+        if self.pending_writes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        # Each commit is an atomic checkpoint of every image added so far
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def completed_files(self):
+        # {path: mtime} of every categorized image; mtime is None for rows imported from legacy JSON
+        return dict(self.connection.execute("SELECT path, mtime FROM images"))
+
+    def mtimes(self, image_paths):
+        # completed_files() for just image_paths (paths not stored are left out), so looking up a batch
+        # costs O(batch) rather than O(library); chunked to stay under SQLite's bound-parameter limit
+        image_paths = list(image_paths)
+        found = {}
+        for start in range(0, len(image_paths), 500):
+            chunk = image_paths[start:start + 500]
+            query = f"SELECT path, mtime FROM images WHERE path IN ({', '.join('?' * len(chunk))})"
+            found.update(self.connection.execute(query, chunk))
+        return found
+
+    def hashes(self):
+        # [(path, category, phash)] of every image stored with a perceptual hash
+        rows = self.connection.execute("SELECT path, category, phash FROM images WHERE phash IS NOT NULL")
+        return [(image_path, category, phash % (1 << 64)) for image_path, category, phash in rows]
+
+    def category_of(self, image_path):
+        row = self.connection.execute("SELECT category FROM images WHERE path = ?", (image_path,)).fetchone()
+        return row[0] if row else None
+
+    def paths_in(self, category):
+        rows = self.connection.execute("SELECT path FROM images WHERE category = ? ORDER BY rowid", (category,))
+        return [row[0] for row in rows]
+
+    def import_json(self, json_path=CATEGORIZED_JSON_PATH):
+        # One-off migration from a legacy categorized.json
+        with open(json_path, "r") as json_file:
+            categorized_data = json.load(json_file)
+        for category, image_paths in categorized_data.items():
+            for image_path in image_paths:
+                self.add(image_path, category)
+        self.commit()
+
+    def export_json(self, json_path=CATEGORIZED_JSON_PATH):
+        # Produce the legacy {"Docs": [...], "People": [...], ...} layout
+        categorized_data = {category: [] for category in CATEGORIES}
+        for image_path, category in self.connection.execute("SELECT path, category FROM images ORDER BY rowid"):
+            categorized_data.setdefault(category, []).append(image_path)
+        with open(json_path, "w") as json_file:
+            json.dump(categorized_data, json_file, indent=4)
+        return categorized_data
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+def open_result_store(path=RESULT_STORE_PATH, commit_every=100, categorized_json_path=CATEGORIZED_JSON_PATH):
+    # Opens the store, migrating an existing categorized.json into it the first time
+    store = ResultStore(path, commit_every)
+    if store.is_empty() and os.path.exists(categorized_json_path):
+        store.import_json(categorized_json_path)
+    return store
+
+# ----------------------------
+# Embedding store: memory-mapped float16 matrix plus an id table, with nearest-neighbour search
+# ----------------------------
+IVF_INDEX_MIN_IMAGES = 1000000  # below this, brute-force search over the matrix is fast enough
+
+def load_faiss():
+    # faiss is optional; without it search always scans the full matrix
+    try:
+        import faiss
+        return faiss
+    except ImportError:
+        return None
+
+class EmbeddingStore:
+    def __init__(self, path=EMBEDDINGS_PATH, search_block_rows=65536):
+        self.matrix_path = path + ".f16"
+        self.search_block_rows = search_block_rows
+        self.connection = sqlite3.connect(path + ".sqlite")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS ids (path TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+        self.connection.commit()
+        meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+        self.dim = meta.get("dim")
+        self.paths = [row[0] for row in self.connection.execute("SELECT path FROM ids ORDER BY row")]
+        self.rows = {image_path: row for row, image_path in enumerate(self.paths)}
+        self.matrix = None
+        self.index = None  # IVF-PQ index, built on demand by build_index()
+        if self.dim is not None:
+            self.open_matrix(max(len(self.paths), 1))
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __contains__(self, image_path):
+        return image_path in self.rows
+
+    def open_matrix(self, capacity):
+        # Grows the file to capacity rows (never shrinks it) and maps it
+        size = capacity * self.dim * 2
+        if self.matrix is not None:
+            self.matrix.flush()
+            self.matrix = None
+        with open(self.matrix_path, "ab") as matrix_file:
+            if matrix_file.tell() < size:
+                matrix_file.truncate(size)
+        capacity = os.path.getsize(self.matrix_path) // (self.dim * 2)
+        self.matrix = np.memmap(self.matrix_path, dtype=np.float16, mode="r+", shape=(capacity, self.dim))
+
+    def add(self, image_path, embedding):
+        # embedding is an L2-normalised vector; re-adding a path overwrites its row
+        if self.dim is None:
+            self.dim = len(embedding)
+            self.connection.execute("INSERT INTO meta (key, value) VALUES ('dim', ?)", (self.dim,))
+            self.open_matrix(1024)
+        elif len(embedding) != self.dim:
+            raise ValueError(f"{self.matrix_path} holds {self.dim}-dimensional embeddings, got {len(embedding)}; "
+                             "use a new embeddings_path for a different embedding tensor")
+        row = self.rows.get(image_path)
+        if row is None:
+            row = len(self.paths)
+            if row >= len(self.matrix):
+                self.open_matrix(2 * len(self.matrix))
+            self.paths.append(image_path)
+            self.rows[image_path] = row
+            self.connection.execute("INSERT INTO ids (path, row) VALUES (?, ?)", (image_path, row))
+            self.index = None
+        self.matrix[row] = embedding
+
+    def vector(self, image_path):
+        row = self.rows.get(image_path)
+        return None if row is None else np.array(self.matrix[row], dtype=np.float32)
+
+    def commit(self):
+        if self.matrix is not None:
+            self.matrix.flush()
+        self.connection.commit()
+
+    def close(self):
+        self.commit()
+        self.connection.close()
+
+    def build_index(self, min_images=IVF_INDEX_MIN_IMAGES, nprobe=16, train_size=200000):
+        # Trains an IVF-PQ index over the matrix once the collection is large enough and faiss is installed.
+        # Returns True when searches will go through the index.
+        faiss = load_faiss()
+        if faiss is None or len(self) < min_images:
+            self.index = None
+            return False
+        count = len(self)
+        nlist = int(4 * np.sqrt(count))
+        subquantizers = next(m for m in (64, 48, 32, 16, 8, 4, 2, 1) if self.dim % m == 0)
+        quantizer = faiss.IndexFlatIP(self.dim)
+        index = faiss.IndexIVFPQ(quantizer, self.dim, nlist, subquantizers, 8, faiss.METRIC_INNER_PRODUCT)
+        sample = np.random.default_rng(0).choice(count, min(count, train_size), replace=False)
+        index.train(np.asarray(self.matrix[np.sort(sample)], dtype=np.float32))
+        for start in range(0, count, self.search_block_rows):
+            index.add(np.asarray(self.matrix[start:min(start + self.search_block_rows, count)], dtype=np.float32))
+        index.nprobe = nprobe
+        self.index = index
+        return True
+
+    def search(self, queries, k=10):
+        # queries is (n, dim) or (dim,); returns, per query, [(path, cosine similarity)] best first
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        count = len(self)
+        k = min(k, count)
+        if k == 0:
+            return [[] for _ in queries]
+        if self.index is not None:
+            scores, rows = self.index.search(queries, k)
+        else:
+            scores, rows = self.brute_force_search(queries, k)
+        return [
+            [(self.paths[row], float(score)) for row, score in zip(query_rows, query_scores) if row >= 0]
+            for query_rows, query_scores in zip(rows, scores)
+        ]
+
+    def brute_force_search(self, queries, k):
+        # Batched dot products over blocks of the matrix, keeping a running top-k per query
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        count = len(self)
+        for start in range(0, count, self.search_block_rows):
+            block = np.asarray(self.matrix[start:min(start + self.search_block_rows, count)], dtype=np.float32)
+            scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+            block_rows = np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))
+            rows = np.concatenate([best_rows, block_rows], axis=1)
+            if scores.shape[1] > k:
+                keep = np.argpartition(scores, -k, axis=1)[:, -k:]
+                scores = np.take_along_axis(scores, keep, axis=1)
+                rows = np.take_along_axis(rows, keep, axis=1)
+            best_scores, best_rows = scores, rows
+        order = np.argsort(-best_scores, axis=1)
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_rows, order, axis=1)
+
+    def similar_to(self, image_path, k=10):
+        # "More like this": neighbours of a stored image, excluding the image itself
+        vector = self.vector(image_path)
+        if vector is None:
+            return []
+        return [match for match in self.search(vector, k + 1)[0] if match[0] != image_path][:k]
+
+# ----------------------------
+# Folder enumeration: streaming os.scandir walk
+# ----------------------------
+IMAGE_SIGNATURES = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"GIF87a", b"GIF89a", b"BM")
+
+def has_image_signature(image_path):
+    # Magic-byte check, so misnamed or truncated-to-nothing files never reach the decoder
+    try:
+        with open(image_path, "rb") as image_file:
+            return image_file.read(8).startswith(IMAGE_SIGNATURES)
+    except OSError:
+        return False
+
+SORTED_LISTING_MAX = 4096  # larger directories are walked in listing order rather than read in full first
+
+def iter_image_files(folder_path, recursive=True, extensions=SUPPORTED_FORMATS, check_signature=False):
+    # Yields (path relative to folder_path, path, mtime) for every image by extension; check_signature also
+    # opens each file, so process_folder only checks the files it is about to categorize.
+    # Directories of up to SORTED_LISTING_MAX entries come out in name order; bigger ones stream in listing
+    # order, so the first images of a huge flat folder reach the pipeline before it is fully listed.
+    # Each file is stat'ed once through its DirEntry.
+    directories = [folder_path]
+    while directories:
+        directory = directories.pop()
+        subdirectories = []
+        try:
+            with os.scandir(directory) as listing:
+                head = list(islice(listing, SORTED_LISTING_MAX))
+                if len(head) < SORTED_LISTING_MAX:
+                    entries = sorted(head, key=lambda entry: entry.name)
+                else:
+                    entries = chain(head, listing)
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if recursive:
+                            subdirectories.append(entry.path)
+                    elif entry.name.lower().endswith(extensions) and entry.is_file():
+                        if check_signature and not has_image_signature(entry.path):
+                            continue
+                        try:
+                            mod_time = entry.stat().st_mtime
+                        except OSError:
+                            continue
+                        yield os.path.relpath(entry.path, folder_path), entry.path, mod_time
+        except OSError:
+            pass  # unreadable or vanished directory: skip the rest of its listing
+        directories.extend(reversed(subdirectories))
+
+# ----------------------------
+# Folder watcher: inotify on Linux, polling elsewhere, debounced until writes settle
+# ----------------------------
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_ISDIR = 0x2, 0x8, 0x80, 0x100, 0x40000000
+IN_Q_OVERFLOW = 0x4000  # the kernel queue filled up and events were dropped; arrives with wd -1
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+INOTIFY_EVENT = struct.Struct("iIII")  # wd, mask, cookie, name length
+
+def load_inotify():
+    # Returns (libc, inotify file descriptor), or None where inotify is unavailable
+    if not hasattr(os, "O_NONBLOCK"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    return (libc, fd) if fd >= 0 else None
+
+class FolderWatcher:
+    def __init__(self, folder_path, settle_seconds=2.0, poll_interval=5.0, extensions=SUPPORTED_FORMATS,
+                 recursive=True):
+        self.folder_path = folder_path
+        self.settle_seconds = settle_seconds
+        self.poll_interval = poll_interval
+        self.extensions = extensions
+        self.recursive = recursive
+        self.last_event = {}  # path -> time of its latest write event
+        self.watched_dirs = {}  # inotify watch descriptor -> directory
+        inotify = load_inotify()
+        self.libc, self.fd = inotify if inotify is not None else (None, None)
+        if self.fd is not None:
+            self.watch_tree(folder_path)
+        self.backend = "inotify" if self.fd is not None else "polling"
+        self.snapshot = self.scan() if self.fd is None else {}
+
+    def watch_tree(self, directory):
+        # Adds a watch on directory (and, when recursive, every directory below it)
+        directories = [directory]
+        while directories:
+            directory = directories.pop()
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), INOTIFY_MASK)
+            if wd >= 0:
+                self.watched_dirs[wd] = directory
+            if self.recursive:
+                try:
+                    with os.scandir(directory) as entries:
+                        directories.extend(entry.path for entry in entries if entry.is_dir(follow_symlinks=False))
+                except OSError:
+                    continue
+
+    def scan(self):
+        # {path: mtime} of the folder's images, for the polling backend
+        return {
+            image_path: mod_time
+            for _, image_path, mod_time in iter_image_files(self.folder_path, self.recursive, self.extensions)
+        }
+
+    def read_events(self, timeout):
+        # Records every write event that arrives within timeout seconds
+        if self.fd is None:
+            time.sleep(timeout)
+            snapshot = self.scan()
+            now = time.monotonic()
+            for image_path, mod_time in snapshot.items():
+                if self.snapshot.get(image_path) != mod_time:
+                    self.last_event[image_path] = now
+            self.snapshot = snapshot
+            return
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return
+        now = time.monotonic()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + name_length].rstrip(b"\0"))
+            offset += name_length
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: rescan the whole tree, watching any folder created meanwhile
+                self.watch_tree(self.folder_path)
+                for _, image_path, _ in iter_image_files(self.folder_path, self.recursive, self.extensions):
+                    self.last_event[image_path] = now
+                continue
+            if wd not in self.watched_dirs:
+                continue
+            path = os.path.join(self.watched_dirs[wd], name)
+            if mask & IN_ISDIR:
+                if self.recursive and mask & (IN_CREATE | IN_MOVED_TO):
+                    # A new subfolder: watch it, and pick up whatever was moved in with it
+                    self.watch_tree(path)
+                    for _, image_path, _ in iter_image_files(path, True, self.extensions):
+                        self.last_event[image_path] = now
+            elif name.lower().endswith(self.extensions):
+                self.last_event[path] = now
+
+    def settled(self):
+        # Paths with no write event for settle_seconds, i.e. whose upload has finished
+        now = time.monotonic()
+        ready = sorted(path for path, last in self.last_event.items() if now - last >= self.settle_seconds)
+        for image_path in ready:
+            del self.last_event[image_path]
+        return ready
+
+    def batches(self, stop_event=None):
+        # Yields lists of settled new/changed image paths until stop_event is set
+        while stop_event is None or not stop_event.is_set():
+            timeout = self.poll_interval if self.fd is None else min(self.settle_seconds, 1.0)
+            self.read_events(timeout)
+            ready = self.settled()
+            if ready:
+                yield ready
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+# ----------------------------
+# Process-pool workers
+# ----------------------------
+worker_categorizer = None
+
+def init_worker(config):
+    # Each worker process builds its own Categorizer, so interpreters are never shared across processes
+    global worker_categorizer
+    worker_categorizer = Categorizer(**config)
+
+def classify_in_worker(image_path, confidence_threshold, fast_decode, resample):
+    return worker_categorizer.classify_image_path(image_path, confidence_threshold, fast_decode, resample)
+
+def classify_prepared_in_worker(image, confidence_threshold, fast_decode, resample):
+    return worker_categorizer.classify_image(image, confidence_threshold, resample)
+
+def open_worker_pool(config, workers):
+    # Worker processes start on first use; reusing one pool across calls keeps their models loaded
+    return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(config,))
+
+def classify_in_pool(config, image_paths, workers, confidence_threshold=0.35, fast_decode=True,
+                     resample=Image.Resampling.LANCZOS, pool=None, prepared=False):
+    # Yields results in input order as they arrive, so merging stays deterministic and can checkpoint as it goes.
+    # With prepared=True, image_paths are images prepare_image already returned.
+    if pool is None:
+        with open_worker_pool(config, workers) as pool:
+            yield from classify_in_pool(config, image_paths, workers, confidence_threshold, fast_decode, resample,
+                                        pool, prepared)
+        return
+    chunksize = max(1, min(64, len(image_paths) // (workers * 4)))
+    yield from pool.map(
+        classify_prepared_in_worker if prepared else classify_in_worker, image_paths, repeat(confidence_threshold),
+        repeat(fast_decode), repeat(resample), chunksize=chunksize
+    )
 
 # ----------------------------
 # Example usage
 # ----------------------------
 if __name__ == "__main__":
     folder_path = '/content/test'  # Replace with your folder path containing images
-    process_folder(folder_path, confidence_threshold=0.35)
+    process_folder(folder_path, confidence_threshold=0.35, workers=os.cpu_count() or 1, export_json=True)
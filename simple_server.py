@@ -1,9 +1,22 @@
 import http.server
 import socketserver
 import os
+import io
+import gzip
 import json
 import time
+import zlib
+import html
+import queue
+import socket
+import hashlib
+import asyncio
+import selectors
+import threading
+import traceback
 import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from http import HTTPStatus, cookies
 try:
     from dotenv import load_dotenv
@@ -11,120 +24,341 @@ try:
     load_dotenv()
 except ImportError:
     print("python-dotenv not installed, using environment variables directly")
+try:
+    # Optional: without it responses are negotiated between gzip and identity only
+    import brotli
+except ImportError:
+    brotli = None
+
+# Seconds a persistent (keep-alive) connection may sit idle between requests before it is closed
+IDLE_TIMEOUT = float(os.environ.get('GALLERYZE_IDLE_TIMEOUT', '5'))
+
+# Bodies smaller than this are sent uncompressed; the encoding overhead outweighs the savings
+MIN_COMPRESS_SIZE = 512
+
+def accepted_encodings(accept_encoding):
+    # (codings the client accepts with q > 0, codings it refuses with q=0), from an Accept-Encoding header
+    accepted, refused = set(), set()
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            (accepted if quality > 0 else refused).add(coding.strip().lower())
+    return accepted, refused
+
+def choose_encoding(accept_encoding, available):
+    # Brotli first, then gzip, out of the variants we have and the client accepts; '*' stands for
+    # any coding not named, so it never brings back one refused with q=0
+    accepted, refused = accepted_encodings(accept_encoding)
+    for coding in ('br', 'gzip'):
+        if coding in available and (coding in accepted or ('*' in accepted and coding not in refused)):
+            return coding
+    return 'identity'
+
+# A response body with its compressed variants, built once so repeat responses never recompress
+class CompressedBody:
+    def __init__(self, content, brotli_quality=11):
+        self.variants = {'identity': content}
+        if len(content) >= MIN_COMPRESS_SIZE:
+            self.variants['gzip'] = gzip.compress(content, compresslevel=9, mtime=0)
+            if brotli is not None:
+                self.variants['br'] = brotli.compress(content, quality=brotli_quality)
+
+class StreamCompressor:
+    # Incremental gzip/brotli encoder for bodies produced piece by piece
+    def __init__(self, coding):
+        if coding == 'br':
+            compressor = brotli.Compressor(quality=5)
+            self.compress, self.finish = compressor.process, compressor.finish
+        else:
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+            self.compress, self.finish = compressor.compress, compressor.flush
+
+# Rendered pages, stored encoded and keyed on the only inputs that change them
+class PageCache:
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.pages = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, render):
+        # Returns the CompressedBody for key, rendering and compressing it with render() the first time
+        with self.lock:
+            page = self.pages.get(key)
+            if page is not None:
+                self.pages.move_to_end(key)
+                return page
+        page = CompressedBody(render().encode(), brotli_quality=6)
+        with self.lock:
+            self.pages[key] = page
+            # Keys come from a fixed set of pages; the bound is a safety net, least recently served go first
+            while len(self.pages) > self.max_entries:
+                self.pages.popitem(last=False)
+        return page
+
+# Fingerprinted static assets: the URL changes whenever the content does, so browsers may keep them for a year
+class StaticAsset:
+    def __init__(self, name, content, content_type):
+        self.name = name
+        self.body = CompressedBody(content)
+        self.content_type = content_type
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        stem, extension = os.path.splitext(name)
+        self.url = f"/static/{stem}.{digest}{extension}"
+        # Each encoding is a different representation, so each gets its own ETag
+        self.etags = {
+            coding: f'"{digest}"' if coding == 'identity' else f'"{digest}-{coding}"'
+            for coding in self.body.variants
+        }
+
+def supabase_client_source():
+    # Supabase credentials from the environment, followed by the client script itself
+    supabase_vars = f"""
+// Supabase environment variables
+window.SUPABASE_URL = '{os.environ.get('SUPABASE_URL')}';
+window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
+"""
+    with open('supabase_client.js', 'rb') as file:
+        return supabase_vars.encode() + file.read()
 
 class GalleryzeHandler(http.server.SimpleHTTPRequestHandler):
+    # HTTP/1.1: connections stay open between requests, so every response carries a Content-Length
+    protocol_version = 'HTTP/1.1'
+    timeout = IDLE_TIMEOUT
+    page_cache = PageCache()
+    # Home page filters with a chip of their own; only these are cached, other /filter/ values render per request
+    cached_filters = ("all", "favorites", "Recent", "Trip", "Family", "Food", "Nature", "Docs")
+    static_assets = None  # name -> StaticAsset, loaded on first use
+    static_routes = {}    # fingerprinted URL -> StaticAsset
+
+    @classmethod
+    def load_static_assets(cls):
+        if cls.static_assets is None:
+            renderer = cls.__new__(cls)
+            with open('new_galleryze_script.js', 'rb') as file:
+                script = file.read()
+            assets = [
+                StaticAsset('app.css', renderer.get_styles().encode(), 'text/css'),
+                StaticAsset('new_galleryze_script.js', script, 'application/javascript'),
+                StaticAsset('supabase_client.js', supabase_client_source(), 'application/javascript'),
+            ]
+            cls.static_routes = {asset.url: asset for asset in assets}
+            cls.static_assets = {asset.name: asset for asset in assets}
+        return cls.static_assets
+
+    def static_url(self, name):
+        return self.load_static_assets()[name].url
+
+    def send_static(self, asset, immutable=True):
+        # Fingerprinted URLs never change content; the legacy unversioned URLs revalidate with the ETag
+        if immutable:
+            cache_control = 'public, max-age=31536000, immutable'
+        else:
+            cache_control = 'no-cache'
+        coding = choose_encoding(self.headers.get('Accept-Encoding'), asset.body.variants)
+        headers = [('ETag', asset.etags[coding]), ('Cache-Control', cache_control)]
+        if self.headers.get('If-None-Match') == asset.etags[coding]:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            for name, value in headers + [('Vary', 'Accept-Encoding')]:
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_body(HTTPStatus.OK, asset.body, asset.content_type, headers)
+
+    def handle(self):
+        # A server that parks idle connections (ThreadPoolHTTPServer) gets them back between requests:
+        # this thread only serves requests the client has already sent, then returns the connection
+        # instead of blocking until the next request or the idle timeout
+        if not hasattr(self.server, 'park_connection'):
+            return super().handle()
+        self.handle_one_request()
+        while not self.close_connection:
+            if not self.request_ready():
+                self.server.park_connection(self.request)
+                return
+            self.handle_one_request()
+
+    def request_ready(self):
+        # Whether the next request (pipelined or already sent) can be read without blocking
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def send_error(self, code, message=None, explain=None):
+        # Malformed requests and clients that asked to close keep the base class behaviour
+        if self.close_connection:
+            return super().send_error(code, message, explain)
+        # Otherwise the same error page, framed by Content-Length so the connection can be reused
+        short_message, long_message = self.responses.get(code, ('???', '???'))
+        message = short_message if message is None else message
+        explain = long_message if explain is None else explain
+        self.log_error("code %d, message %s", code, message)
+        content = (self.error_message_format % {
+            'code': code,
+            'message': html.escape(message, quote=False),
+            'explain': html.escape(explain, quote=False),
+        }).encode('UTF-8', 'replace')
+        self.send_response(code, message)
+        self.send_header('Content-Type', self.error_content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def send_body(self, status, body, content_type, headers=()):
+        # Sends the best variant of a CompressedBody for this client's Accept-Encoding
+        coding = choose_encoding(self.headers.get('Accept-Encoding'), body.variants)
+        content = body.variants[coding]
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        if len(body.variants) > 1:
+            self.send_header('Vary', 'Accept-Encoding')
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def send_json(self, status, payload, headers=()):
+        # Dynamic JSON: encoded piece by piece, and compressed as it is produced when it is large enough
+        chunks = [chunk.encode() for chunk in json.JSONEncoder().iterencode(payload)]
+        self.send_compressed(status, chunks, 'application/json', headers)
+
+    def send_compressed(self, status, chunks, content_type, headers=()):
+        # Bodies built per request: compressed on the fly at a cheap level, never cached
+        size = sum(len(chunk) for chunk in chunks)
+        available = ('br', 'gzip') if brotli is not None else ('gzip',)
+        coding = choose_encoding(self.headers.get('Accept-Encoding'), available)
+        if size < MIN_COMPRESS_SIZE:
+            coding = 'identity'
+        if coding != 'identity':
+            compressor = StreamCompressor(coding)
+            chunks = [compressor.compress(chunk) for chunk in chunks] + [compressor.finish()]
+        content = b''.join(chunks)
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Vary', 'Accept-Encoding')
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    @classmethod
+    def prerender_pages(cls):
+        # The shared pages don't depend on the request, so they can be rendered without one
+        cls.load_static_assets()
+        renderer = cls.__new__(cls)
+        for key, render in renderer.shared_pages().items():
+            cls.page_cache.get(key, render)
+
+    def shared_pages(self):
+        pages = {
+            ("login",): self.get_login_page,
+            ("signup",): self.get_signup_page,
+            ("categories",): self.get_categories_page,
+        }
+        for filter_type in self.cached_filters:
+            pages[("home", filter_type)] = lambda filter_type=filter_type: self.get_home_page(filter_type)
+        return pages
+
+    def send_page(self, key, render):
+        self.send_body(HTTPStatus.OK, self.page_cache.get(key, render), 'text/html')
+
+    def send_uncached_page(self, render):
+        # Pages whose key the client controls (cookie details, custom filters) must not fill or churn the cache
+        self.send_compressed(HTTPStatus.OK, [render().encode()], 'text/html')
+
     def do_GET(self):
         # Check if requesting login or signup page
         if self.path == '/login':
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(self.get_login_page().encode())
+            self.send_page(("login",), self.get_login_page)
         elif self.path == '/signup':
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'text/html')
-            self.end_headers()
-            self.wfile.write(self.get_signup_page().encode())
+            self.send_page(("signup",), self.get_signup_page)
+        elif self.path.startswith('/static/'):
+            # Stylesheet and scripts, under URLs fingerprinted with their content hash
+            self.load_static_assets()
+            asset = self.static_routes.get(self.path)
+            if asset is None:
+                self.send_error(HTTPStatus.NOT_FOUND, "File not found")
+            else:
+                self.send_static(asset)
         # Check if user is logged in (has valid session cookie)
         elif self.path == '/supabase_client.js':
-            # Read Supabase client JS and inject environment variables
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/javascript')
-            self.end_headers()
-            
-            # Inject Supabase credentials from environment variables
-            supabase_vars = f"""
-// Supabase environment variables
-window.SUPABASE_URL = '{os.environ.get('SUPABASE_URL')}';
-window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
-"""
-            # Write the environment variables first, then the content of the file
-            self.wfile.write(supabase_vars.encode())
-            
-            with open('supabase_client.js', 'rb') as file:
-                self.wfile.write(file.read())
+            # Supabase client JS with the environment's credentials injected
+            self.send_static(self.load_static_assets()['supabase_client.js'], immutable=False)
         elif self.is_authenticated() or self.path == '/new_galleryze_script.js':
             # Serve app content for authenticated users
             if self.path == '/' or self.path == '/home':
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_home_page("all").encode())
+                self.send_page(("home", "all"), lambda: self.get_home_page("all"))
             elif self.path == '/favorites':
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_home_page("favorites").encode())
+                self.send_page(("home", "favorites"), lambda: self.get_home_page("favorites"))
             elif self.path == '/categories':
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_categories_page().encode())
+                self.send_page(("categories",), self.get_categories_page)
             elif self.path == '/new_galleryze_script.js':
                 # Serve our JavaScript file
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'application/javascript')
-                self.end_headers()
-                with open('new_galleryze_script.js', 'rb') as file:
-                    self.wfile.write(file.read())
+                self.send_static(self.load_static_assets()['new_galleryze_script.js'], immutable=False)
             elif self.path.startswith('/filter/'):
                 # Handle filtering by category
                 category = self.path.split('/')[2]
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_home_page(category).encode())
+                if category in self.cached_filters:
+                    self.send_page(("home", category), lambda: self.get_home_page(category))
+                else:
+                    self.send_uncached_page(lambda: self.get_home_page(category))
             elif self.path == '/settings':
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_settings_page().encode())
+                # Profile and settings show the signed-in user's details, so they are rendered per request
+                self.send_uncached_page(self.get_settings_page)
             elif self.path == '/profile':
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'text/html')
-                self.end_headers()
-                self.wfile.write(self.get_profile_page().encode())
+                self.send_uncached_page(self.get_profile_page)
             elif self.path == '/api/user':
                 # Get current user info
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"user": self.get_user_info()}).encode())
+                self.send_json(HTTPStatus.OK, {"user": self.get_user_info()})
             elif self.path == '/api/favorites':
                 # Get user's favorites
                 if not self.is_authenticated():
-                    self.send_response(HTTPStatus.UNAUTHORIZED)
-                    self.send_header('Content-type', 'application/json')
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                    self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                     return
                 
                 # Here we would fetch from Supabase, but for now return dummy data
                 user_info = self.get_user_info()
-                self.send_response(HTTPStatus.OK)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
                 # Mock favorites for photo2 and photo5
-                self.wfile.write(json.dumps({
+                self.send_json(HTTPStatus.OK, {
                     "success": True, 
                     "favorites": [
                         {"user_id": user_info["id"], "photo_id": "photo2", "is_favorite": True},
                         {"user_id": user_info["id"], "photo_id": "photo5", "is_favorite": True}
                     ]
-                }).encode())
+                })
             else:
                 self.send_error(HTTPStatus.NOT_FOUND, "Page not found")
         else:
             # Redirect unauthenticated users to login page
             self.send_response(HTTPStatus.FOUND)
             self.send_header('Location', '/login')
+            self.send_header('Content-Length', '0')
             self.end_headers()
     
     def do_POST(self):
+        # Read the whole body up front, so a persistent connection is left at the start of the next
+        # request whichever branch answers (including the early 401s and the 404 below)
+        post_data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
         # Handle API endpoints
         if self.path == '/api/login':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Process login request
@@ -135,32 +369,21 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Verify that we have user ID and token from Supabase
             if not user_id or not supabase_token:
-                self.send_response(HTTPStatus.BAD_REQUEST)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self.send_json(HTTPStatus.BAD_REQUEST, {
                     "success": False, 
                     "message": "Missing user credentials"
-                }).encode())
+                })
                 return
                 
             # In a production app, we would verify the token with Supabase
             # For this demo, we'll trust the token and set a session
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            
             # Store user ID, email, and display name in session cookie
             session_data = f"{user_id}:{email}:{display_name}"
-            self.send_header('Set-Cookie', f'session={session_data}; Path=/')
-            
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json(HTTPStatus.OK, {
                 "success": True, 
                 "message": "Logged in successfully"
-            }).encode())
+            }, headers=[('Set-Cookie', f'session={session_data}; Path=/')])
         elif self.path == '/api/signup':
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Process signup request
@@ -170,13 +393,10 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Verify we have necessary data
             if not name or not email or not user_id:
-                self.send_response(HTTPStatus.BAD_REQUEST)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({
+                self.send_json(HTTPStatus.BAD_REQUEST, {
                     "success": False, 
                     "message": "Missing required signup information"
-                }).encode())
+                })
                 return
             
             # Set default subscription to 'free'
@@ -185,10 +405,7 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             # In a production app, we would store user metadata (name, subscription_plan) in Supabase
             # Also create entries in the profiles table or similar
             
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json(HTTPStatus.OK, {
                 "success": True, 
                 "message": "Signed up successfully", 
                 "user": {
@@ -197,7 +414,7 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
                     "email": email,
                     "subscription_plan": subscription_plan
                 }
-            }).encode())
+            })
         elif self.path == '/api/logout':
             # Process logout request
             cookie = cookies.SimpleCookie()
@@ -205,22 +422,14 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             cookie['session']['path'] = '/'
             cookie['session']['expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'  # Expire the cookie
             
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Set-Cookie', cookie['session'].OutputString())
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "message": "Logged out successfully"}).encode())
+            self.send_json(HTTPStatus.OK, {"success": True, "message": "Logged out successfully"},
+                           headers=[('Set-Cookie', cookie['session'].OutputString())])
         elif self.path == '/api/categories':
             # Only process if user is authenticated
             if not self.is_authenticated():
-                self.send_response(HTTPStatus.UNAUTHORIZED)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                 return
                 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Save category data
@@ -229,21 +438,13 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Here we would save to Supabase database
             # For now, just return a success message
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "message": "Categories saved successfully"}).encode())
+            self.send_json(HTTPStatus.OK, {"success": True, "message": "Categories saved successfully"})
         elif self.path == '/api/favorites':
             # Only process if user is authenticated
             if not self.is_authenticated():
-                self.send_response(HTTPStatus.UNAUTHORIZED)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                 return
                 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Get favorite data
@@ -252,21 +453,13 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Here we would save to Supabase database
             # For now, just return a success message
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({"success": True, "message": "Favorite status saved successfully"}).encode())
+            self.send_json(HTTPStatus.OK, {"success": True, "message": "Favorite status saved successfully"})
         elif self.path == '/api/categories/create':
             # Only process if user is authenticated
             if not self.is_authenticated():
-                self.send_response(HTTPStatus.UNAUTHORIZED)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                 return
                 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Get category data
@@ -274,38 +467,27 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Validate the category name
             if not category_name or len(category_name.strip()) == 0:
-                self.send_response(HTTPStatus.BAD_REQUEST)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Category name cannot be empty"}).encode())
+                self.send_json(HTTPStatus.BAD_REQUEST, {"success": False, "message": "Category name cannot be empty"})
                 return
             
             # This will be processed on the client side with galleryzeApi.createCategory
             # We just need to return a success response here
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
             # Use a timestamp for a more unique ID
             category_id = f"{category_name.lower().replace(' ', '-')}-{int(time.time()) % 10000}"
-            self.wfile.write(json.dumps({
+            self.send_json(HTTPStatus.OK, {
                 "success": True, 
                 "message": "Category created successfully", 
                 "category": {
                     "name": category_name, 
                     "id": category_id
                 }
-            }).encode())
+            })
         elif self.path == '/api/categories/update':
             # Only process if user is authenticated
             if not self.is_authenticated():
-                self.send_response(HTTPStatus.UNAUTHORIZED)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                 return
                 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Get category data
@@ -314,36 +496,25 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Validate the category name and ID
             if not category_id or not category_name or len(category_name.strip()) == 0:
-                self.send_response(HTTPStatus.BAD_REQUEST)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Category ID and name are required"}).encode())
+                self.send_json(HTTPStatus.BAD_REQUEST, {"success": False, "message": "Category ID and name are required"})
                 return
             
             # Here we would update in Supabase database
             # For now, just return a success message
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json(HTTPStatus.OK, {
                 "success": True, 
                 "message": "Category updated successfully", 
                 "category": {
                     "name": category_name, 
                     "id": category_id
                 }
-            }).encode())
+            })
         elif self.path == '/api/categories/delete':
             # Only process if user is authenticated
             if not self.is_authenticated():
-                self.send_response(HTTPStatus.UNAUTHORIZED)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Not authenticated"}).encode())
+                self.send_json(HTTPStatus.UNAUTHORIZED, {"success": False, "message": "Not authenticated"})
                 return
                 
-            content_length = int(self.headers['Content-Length'])
-            post_data = self.rfile.read(content_length)
             data = json.loads(post_data.decode('utf-8'))
             
             # Get category ID
@@ -351,22 +522,16 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             
             # Validate the category ID
             if not category_id:
-                self.send_response(HTTPStatus.BAD_REQUEST)
-                self.send_header('Content-type', 'application/json')
-                self.end_headers()
-                self.wfile.write(json.dumps({"success": False, "message": "Category ID is required"}).encode())
+                self.send_json(HTTPStatus.BAD_REQUEST, {"success": False, "message": "Category ID is required"})
                 return
             
             # Here we would delete from Supabase database
             # For now, just return a success message
-            self.send_response(HTTPStatus.OK)
-            self.send_header('Content-type', 'application/json')
-            self.end_headers()
-            self.wfile.write(json.dumps({
+            self.send_json(HTTPStatus.OK, {
                 "success": True, 
                 "message": "Category deleted successfully", 
                 "categoryId": category_id
-            }).encode())
+            })
         # No else here, as we've already handled all of our API endpoints
         else:
             self.send_error(HTTPStatus.NOT_FOUND, "Endpoint not found")
@@ -436,10 +601,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Home</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-                {self.get_styles()}
-            </style>
-            <script src="/new_galleryze_script.js"></script>
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
+            <script src="{self.static_url('new_galleryze_script.js')}"></script>
         </head>
         <body>
             <nav class="top-nav">
@@ -686,10 +849,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Categories</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
-            <style>
-                {self.get_styles()}
-            </style>
-            <script src="/new_galleryze_script.js"></script>
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
+            <script src="{self.static_url('new_galleryze_script.js')}"></script>
         </head>
         <body>
             <nav class="top-nav">
@@ -831,7 +992,6 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
         """
     
     def get_login_page(self):
-        styles = self.get_styles()
         return f"""
         <!DOCTYPE html>
         <html>
@@ -839,8 +999,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Login</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
             <style>
-                {styles}
                 
                 body {{
                     font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
@@ -962,7 +1122,7 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
                 }}
             </style>
             <script src="https://cdn.jsdelivr.net/npm/@supabase/supabase-js@2"></script>
-            <script src="/supabase_client.js"></script>
+            <script src="{self.static_url('supabase_client.js')}"></script>
             <script>
                 async function handleLogin(event) {{
                     event.preventDefault();
@@ -1050,7 +1210,6 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
         """
     
     def get_signup_page(self):
-        styles = self.get_styles()
         return f"""
         <!DOCTYPE html>
         <html>
@@ -1058,8 +1217,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Sign Up</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
             <style>
-                {styles}
                 
                 body {{
                     font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif;
@@ -1182,7 +1341,7 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
                 }}
             </style>
             <script src="https://cdn.jsdelivr.net/npm/@supabase/supabase-js@2"></script>
-            <script src="/supabase_client.js"></script>
+            <script src="{self.static_url('supabase_client.js')}"></script>
             <script>
                 async function handleSignup(event) {{
                     event.preventDefault();
@@ -1276,7 +1435,6 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
     
     def get_profile_page(self):
         user_info = self.get_user_info()
-        styles = self.get_styles()
         name = user_info['name']
         email = user_info['email']
         first_initial = name[0].upper()
@@ -1288,8 +1446,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Profile</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
             <style>
-                {styles}
                 
                 .profile-container {{
                     max-width: 600px;
@@ -1370,7 +1528,7 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
                     cursor: pointer;
                 }}
             </style>
-            <script src="/new_galleryze_script.js"></script>
+            <script src="{self.static_url('new_galleryze_script.js')}"></script>
             <script>
                 async function handleLogout() {{
                     try {{
@@ -1467,8 +1625,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             <title>Galleryze - Profile</title>
             <meta charset="UTF-8">
             <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <link rel="stylesheet" href="{self.static_url('app.css')}">
             <style>
-                {self.get_styles()}
                 
                 /* Status Bar */
                 .status-bar {{
@@ -1687,8 +1845,8 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
                 }}
             </style>
             <script src="https://cdn.jsdelivr.net/npm/@supabase/supabase-js@2"></script>
-            <script src="/supabase_client.js"></script>
-            <script src="/new_galleryze_script.js"></script>
+            <script src="{self.static_url('supabase_client.js')}"></script>
+            <script src="{self.static_url('new_galleryze_script.js')}"></script>
         </head>
         <body>
             <!-- Status Bar -->
@@ -2027,10 +2185,207 @@ window.SUPABASE_KEY = '{os.environ.get('SUPABASE_KEY')}';
             .full-width { width: 100%; }
         """
 
+# Thread-pool server: many connections at once, with at most max_workers handled concurrently.
+# Workers only hold a connection while it has a request to serve; idle keep-alive connections wait on
+# one selector thread until their next request arrives or they sit idle for idle_timeout seconds.
+class ThreadPoolHTTPServer(socketserver.TCPServer):
+    allow_reuse_address = True
+    request_queue_size = 256  # listen backlog; connections wait here while every worker is busy
+
+    def __init__(self, server_address, handler_class, max_workers=32, idle_timeout=IDLE_TIMEOUT):
+        super().__init__(server_address, handler_class)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="galleryze")
+        self.free_workers = threading.BoundedSemaphore(max_workers)
+        self.idle_timeout = idle_timeout
+        self.parking = set()  # connections whose handler returned them idle, still on their worker
+        self.parked = queue.SimpleQueue()  # (connection, client address) handed over to the idle watcher
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.idle_watcher = threading.Thread(target=self.watch_idle_connections, name="galleryze-idle",
+                                             daemon=True)
+        self.idle_watcher.start()
+
+    def park_connection(self, request):
+        self.parking.add(request)
+
+    def process_request(self, request, client_address):
+        # Stop accepting while every worker is busy, so the backlog (not memory) absorbs bursts
+        self.free_workers.acquire()
+        self.executor.submit(self.process_request_in_worker, request, client_address)
+
+    def process_request_in_worker(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.parking.discard(request)
+            self.handle_error(request, client_address)
+        finally:
+            if request in self.parking:
+                self.parking.discard(request)
+                self.parked.put((request, client_address))
+                try:
+                    self.wakeup_writer.send(b"\0")
+                except OSError:
+                    self.shutdown_request(request)  # the server is closing
+            else:
+                self.shutdown_request(request)
+            self.free_workers.release()
+
+    def watch_idle_connections(self):
+        # Waits on every idle connection at once; a readable one goes back through process_request
+        # (and so waits for a free worker), one idle past its deadline is closed
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_reader, selectors.EVENT_READ)
+        idle = {}  # connection -> (client address, monotonic deadline)
+        while True:
+            now = time.monotonic()
+            next_deadline = min((deadline for _, deadline in idle.values()), default=now + self.idle_timeout)
+            for key, _ in selector.select(max(0.0, next_deadline - now)):
+                if key.fileobj is self.wakeup_reader:
+                    if not self.wakeup_reader.recv(4096):
+                        # server_close: drop whatever is still idle
+                        for request in idle:
+                            self.shutdown_request(request)
+                        selector.close()
+                        return
+                    continue
+                selector.unregister(key.fileobj)
+                client_address, _ = idle.pop(key.fileobj)
+                self.process_request(key.fileobj, client_address)
+            while True:
+                try:
+                    request, client_address = self.parked.get_nowait()
+                except queue.Empty:
+                    break
+                selector.register(request, selectors.EVENT_READ)
+                idle[request] = (client_address, time.monotonic() + self.idle_timeout)
+            now = time.monotonic()
+            for request, (_, deadline) in list(idle.items()):
+                if deadline <= now:
+                    selector.unregister(request)
+                    del idle[request]
+                    self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.wakeup_writer.close()
+        self.idle_watcher.join()
+        self.wakeup_reader.close()
+        self.executor.shutdown(wait=True)
+
+# asyncio server: sockets are read and written by the event loop, and each fully received request is
+# handed to GalleryzeHandler in memory, so slow clients never hold a thread
+class BufferedConnection:
+    # Stands in for the client socket: the handler reads the buffered request and its output is collected
+    def __init__(self, request_bytes):
+        self.request_bytes = request_bytes
+        self.output = io.BytesIO()
+
+    def makefile(self, mode, *args, **kwargs):
+        return io.BytesIO(self.request_bytes)
+
+    def sendall(self, data):
+        self.output.write(data)
+
+    def settimeout(self, timeout):
+        pass
+
+class AsyncHTTPServer:
+    max_request_bytes = 1024 * 1024
+
+    def __init__(self, server_address, handler_class, idle_timeout=IDLE_TIMEOUT):
+        self.server_address = server_address
+        self.handler_class = handler_class
+        self.idle_timeout = idle_timeout
+
+    def respond(self, request_bytes, client_address):
+        # Runs the handler on one buffered request; returns (response bytes, whether to close the connection).
+        # Only one request is handled, so close_connection reflects the request's own Connection header
+        # rather than the end of the buffer.
+        # The handler is built without __init__ (which would serve the request itself), so the
+        # attributes SimpleHTTPRequestHandler.__init__ sets are filled in here.
+        connection = BufferedConnection(request_bytes)
+        handler = self.handler_class.__new__(self.handler_class)
+        handler.request, handler.client_address, handler.server = connection, client_address, self
+        handler.directory = os.getcwd()
+        handler.setup()
+        try:
+            handler.handle_one_request()
+        except Exception:
+            # As socketserver does for the other modes, log the traceback; then replace whatever part of
+            # the response was written with a 500 and close the connection
+            traceback.print_exc()
+            connection.output = io.BytesIO()
+            handler._headers_buffer = []
+            handler.close_connection = True
+            handler.send_error(HTTPStatus.INTERNAL_SERVER_ERROR)
+        finally:
+            handler.finish()
+        return connection.output.getvalue(), handler.close_connection
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                # Idle keep-alive connections are dropped after idle_timeout seconds without a new request
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), self.idle_timeout)
+                content_length = 0
+                for line in head.split(b"\r\n")[1:]:
+                    name, _, value = line.partition(b":")
+                    if name.strip().lower() == b"content-length":
+                        content_length = int(value.strip() or 0)
+                if content_length > self.max_request_bytes:
+                    break
+                body = await reader.readexactly(content_length) if content_length else b""
+                response, close_connection = self.respond(head + body, client_address)
+                writer.write(response)
+                await writer.drain()
+                if close_connection:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError,
+                ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        host, port = self.server_address
+        server = await asyncio.start_server(self.handle_connection, host, port, backlog=256)
+        async with server:
+            await server.serve_forever()
+
+    def serve_forever(self):
+        asyncio.run(self.serve())
+
 # Set up the server
 PORT = 5000
 Handler = GalleryzeHandler
+# "threaded" (default), "asyncio", or "single" for the original one-request-at-a-time TCPServer
+SERVER_MODE = os.environ.get('GALLERYZE_SERVER_MODE', 'threaded')
+MAX_WORKERS = int(os.environ.get('GALLERYZE_MAX_WORKERS', '32'))
+
+def make_server(mode=SERVER_MODE, port=PORT, max_workers=MAX_WORKERS, idle_timeout=IDLE_TIMEOUT):
+    address = ("0.0.0.0", port)
+    Handler.timeout = idle_timeout
+    if mode == "threaded":
+        return ThreadPoolHTTPServer(address, Handler, max_workers, idle_timeout)
+    if mode == "asyncio":
+        return AsyncHTTPServer(address, Handler, idle_timeout)
+    if mode == "single":
+        # One connection at a time, so each is closed after its response (HTTP/1.0) rather than kept
+        # alive, which would leave every other client waiting until it idled out
+        class SingleConnectionHandler(Handler):
+            protocol_version = 'HTTP/1.0'
+        return socketserver.TCPServer(address, SingleConnectionHandler)
+    raise ValueError(f"Unknown server mode {mode!r}; use 'threaded', 'asyncio' or 'single'")
 
-with socketserver.TCPServer(("0.0.0.0", PORT), Handler) as httpd:
-    print(f"Server running at http://0.0.0.0:{PORT}")
-    httpd.serve_forever()
\ No newline at end of file
+if __name__ == "__main__":
+    Handler.prerender_pages()
+    httpd = make_server()
+    print(f"Server running at http://0.0.0.0:{PORT} ({SERVER_MODE})")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if hasattr(httpd, 'server_close'):
+            httpd.server_close()
\ No newline at end of file